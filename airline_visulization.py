@@ -2,32 +2,7 @@
 from math import *
 from pylab import *
 import vtk
-
-
-def create_poly():
-    """create 3 arrrays to store data"""
-    points = vtk.vtkPoints()
-    vertices = vtk.vtkCellArray()
-    zvalues = vtk.vtkFloatArray()
-    return (points, vertices, zvalues)
-
-
-def insert_value(points, vertices, zvalues, x, y, z):
-    """pumping up the 3 arrays"""
-    id = points.InsertNextPoint(x, y, z)
-    vertex = vtk.vtkVertex()
-    vertex.GetPointIds().InsertNextId(id)
-    vertices.InsertNextCell(vertex)
-    zvalues.InsertNextValue(z)
-
-
-def set_poly(points, vertices, zvalues):
-    """set 3 arrays"""
-    polyData = vtk.vtkPolyData()
-    polyData.SetPoints(points)
-    polyData.SetVerts(vertices)
-    polyData.GetPointData().SetScalars(zvalues)
-    return polyData
+from vtk_utils import build_poly
 
 
 def write_poly(polyData, vtpName):
@@ -67,8 +42,8 @@ def draw_arc(startlon, startlat, endlon, endlat, n, upper,outname):
     pts = []
     X=[]  #to visualize the points in python
     Y=[]
-    points, vertices, zvalues = create_poly()
-    insert_value(points, vertices, zvalues,startlon, startlat, 0.11446)
+    lons = [startlon]
+    lats = [startlat]
     for i in range(0,int(n)):
         t = dt * i/u
         if upper == False:
@@ -83,9 +58,12 @@ def draw_arc(startlon, startlat, endlon, endlat, n, upper,outname):
         X.append(new_lon)
         Y.append(new_lat)
         #print("appended",(new_lon,new_lat))
-        insert_value(points, vertices, zvalues, new_lon, new_lat, 0.11446)
-    insert_value(points, vertices, zvalues, endlon, endlat, 0.11446)
-    poly_data = set_poly(points, vertices, zvalues)
+        lons.append(new_lon)
+        lats.append(new_lat)
+    lons.append(endlon)
+    lats.append(endlat)
+    zvalues = [0.11446] * len(lons)
+    poly_data = build_poly(lons, lats, zvalues, zvalues)
     write_poly(poly_data, "airlines/{}.vtp".format(outname))
     plot(X, Y)
     scatter(X, Y)
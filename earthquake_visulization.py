@@ -10,29 +10,213 @@
 """
 
 import glob
-from struct import unpack
+import argparse
+import contextlib
+import csv
+import hashlib
+import json
+import logging
+import shutil
+import multiprocessing
+import time
 import numpy as np
 import vtk
 import os
 from osgeo import gdal
+from vtk.util import numpy_support
 from math import *
+from vtk_utils import build_poly, build_triangles, configure_writer, with_points_precision, write_vtkhdf_series
+from vtk_utils import write_vtp_chunks, map_vtp
+from vtk_utils import VTP_ENCODINGS, VTP_COMPRESSORS, VTP_PRECISIONS
 
-BIG_ENDIAN_FORMAT = '>fff'
-LITTLE_ENDIAN_FORMAT = '<fff'
+try:
+    import resource  # unix only, peak memory is reported as 0 without it
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+BIG_ENDIAN_FORMAT = '>f4'
+LITTLE_ENDIAN_FORMAT = '<f4'
 BINARY_PREFIX_FORMAT = '{}{:04d}'
 CONVERTED_FILE_FORMAT = '{}_zvalues_{:04d}.vtp'
 FLAT_TERRAIN_NAME = 'flat_terrain.vtp'
 ElEVATED_TERRAIN_NAME = 'elevated_terrain.vtp'
+FLAT_TERRAIN_LOD_FORMAT = 'flat_terrain_lod{:02d}.vtp'          # flat terrain reduced by a level-of-detail factor
+ELEVATED_TERRAIN_LOD_FORMAT = 'elevated_terrain_lod{:02d}.vtp'
+ELEVATED_TERRAIN_LOD_INDEX = 'elevated_terrain_lod.vtm'        # multiblock of all elevated levels, coarsest first
+TERRAIN_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'earthquake_visulization', 'terrain')
 BOUNDARY_FILENAME = 'boundary.vtp'
 BOUNDARY_W_TERRAIN = 'boundary_warp_terrain.vtp'
 AMP_WARP_FORMAT = 'amplitudeWarpSurface_{:04d}.vtp'
+PROBE_WEIGHTS_NAME = 'probe_weights.npz'
 FAULT_DATA_FORMAT = 'fault_rapture_data_{:04d}.vtp'
 FAULT_WARP_FORMAT = 'fault_warp_terrain_{:04d}.vtp'
+AMP_SERIES_NAME = 'pushed_amplitudeWarpSurface.vtkhdf'  # all pushed amplitude timesteps in one file
+AMP_INTERP_FORMAT = 'pushed_amplitudeWarpSurface_{:04d}_{:02d}.vtp'  # frames interpolated after a timestep
+AMP_TIMELINE_NAME = 'pushed_amplitudeWarpSurface.pvd'  # pushed timesteps and interpolated frames, in time order
+MANIFEST_NAME = 'build_manifest.json'  # inputs, parameters and outputs of every step of the last run
+REPORT_NAME = 'pipeline_report.json'  # time, memory and throughput of every step, .csv for a csv report
+SCALAR_STATS_NAME = 'amplitude_stats.json'  # range, quantiles and histogram of the amplitude over all timesteps
+REPORT_FIELDS = ('stage', 'skipped', 'wall_s', 'cpu_s', 'peak_rss_bytes', 'points', 'points_per_s', 'bytes_written')
+STAGE_REPORT = []  # one record per measured step or timestep, in the order they finished
+OPEN_STAGES = []   # records of the stages running now, written points are counted into all of them
 ZZ_DIVISION_FACTOR = 25000.    # reduce elevation of the terrain
 IN_SEA = -32768.
 COUNTER_FACTOR = 10            # reduce resolution of the terrain
+LOD_FACTORS = (40, 20, 10, 5)  # suggested level-of-detail pyramid, see --lod
+RESAMPLE_METHODS = ('nearest', 'average', 'max')  # how COUNTER_FACTOR x COUNTER_FACTOR pixels become one terrain point
+READ_BLOCK_ROWS = 64           # number of terrain rows read from a tif at a time
+ADAPTIVE_MAX_BLOCK = 64        # largest quadtree cell, in terrain points, an adaptive terrain collapses to its corners
 SCALAR_DIVISION_FACTOR = 700.  # reduce elevation of moving mountains
+SCALAR_LIFT = 0.01             # with --auto-scalar-division, lift of the amplitude at its AUTO_SCALAR_QUANTILE
+AUTO_SCALAR_QUANTILE = 0.99
+STATS_ACCURACY = 0.01          # relative error of the quantiles in SCALAR_STATS_NAME
+STATS_MIN_VALUE = 1e-9         # smaller amplitudes are counted as zero by the quantile sketch
+STATS_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+STATS_BINS = 64                # histogram bins between the global min and max
+BOUNDARY_PUSH_OFFSET = 0.015   # boundary sits this much above the faults
+AMP_PUSH_OFFSET = 0.01         # amplitude surface sits this much above the faults
 FILL_FAULTS_FACTOR = 2  # increase the number of points within the faults surface so that all the elevations can be seen
+CHUNK_POINTS = 1 << 20         # number of points read at a time when streaming a binary file
+CHUNK_BYTES_PER_POINT = 512    # rough peak memory per amplitude point while a chunk is located, warped and written
+PROBE_WEIGHTS_CHUNKED_NAME = 'probe_weights.npy'    # probe weights of a chunked run, memory-mapped
+AMP_TRIANGLES_NAME = 'amplitude_triangles.npy'      # triangulation of the amplitude points of a chunked run
+REGION_POINTS_FORMAT = 'region_points_{:04d}.vtp'   # amplitude points inside the region, mapped while streamed
+AMP_MESH_VERSION = 2   # bump when amplitude_triangulation changes its triangles (2: lattice before delaunay)
+TERRAIN_MESH_VERSION = 2  # bump when the flat terrain vtp changes its cells (2: raster_triangles of a whole terrain)
+AMP_POINT_ARRAYS = (('Scalars_', np.float32, 1), ('vtkValidPointMask', np.int8, 1))  # point data of a warped frame
+WRITER_OPTIONS = {'encoding': None, 'compressor': None, 'level': None, 'precision': None}  # None keeps the vtk default
+
+
+# ===================================================================================================================
+# INSTRUMENTATION: wall time, cpu time, peak memory, throughput and bytes written of every step
+
+def peak_rss():
+    """peak resident memory of this process in bytes since the last reset_peak_rss, VmHWM of /proc/self/status.
+       Without /proc (not linux) it is ru_maxrss, the peak of the whole run so far"""
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        pass
+    if resource is not None:  # ru_maxrss is in kilobytes on linux
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return 0
+
+
+def reset_peak_rss():
+    """start a new peak for peak_rss by writing 5 to /proc/self/clear_refs.
+       The running stages are given the peak reached so far first, so they keep the peak of their whole run"""
+
+    peak = peak_rss()
+    for record in OPEN_STAGES:
+        record['peak_rss_bytes'] = max(record.get('peak_rss_bytes', 0), peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def usage():
+    """wall time, cpu time of this process and its finished children (the pool workers),
+       peak resident memory since the last reset_peak_rss and peak of the biggest finished child so far in bytes"""
+
+    times = os.times()
+    children_peak = 0
+    if resource is not None:  # ru_maxrss is in kilobytes on linux
+        children_peak = 1024 * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return {'wall': time.perf_counter(),
+            'cpu': times.user + times.system + times.children_user + times.children_system,
+            'peak_rss': peak_rss(), 'children_peak_rss': children_peak}
+
+
+def count_points(n):
+    """add n processed points to every stage running now"""
+
+    for record in OPEN_STAGES:
+        record['points'] += n
+
+
+def counted(poly_datas):
+    """yield poly_datas, counting their points into the running stages"""
+
+    for poly_data in poly_datas:
+        count_points(poly_data.GetNumberOfPoints())
+        yield poly_data
+
+
+def finish_stage(record, start, outputs=()):
+    """complete record with what was spent since the usage snapshot start
+       and the size of the files in outputs, and add it to STAGE_REPORT.
+       The peak memory is the one since the stage started (see reset_peak_rss), or that of a pool worker
+       which finished during the stage if it grew beyond every earlier one.
+       Return the usage snapshot at the end so the next stage can start from it"""
+
+    end = usage()
+    record['wall_s'] = end['wall'] - start['wall']
+    record['cpu_s'] = end['cpu'] - start['cpu']
+    children_peak = end['children_peak_rss'] if end['children_peak_rss'] > start['children_peak_rss'] else 0
+    record['peak_rss_bytes'] = max(record.get('peak_rss_bytes', 0), end['peak_rss'], children_peak)
+    record['points_per_s'] = record['points'] / record['wall_s'] if record['wall_s'] > 0 else 0.
+    record['bytes_written'] = sum(os.path.getsize(name) for name in outputs if os.path.exists(name))
+    STAGE_REPORT.append(record)
+    logger.info("%s took %.2fs wall %.2fs cpu, %d points, %d bytes written", record['stage'], record['wall_s'],
+                record['cpu_s'], record['points'], record['bytes_written'])
+
+    return end
+
+
+@contextlib.contextmanager
+def measure(name):
+    """measure the body as stage name. The record of the stage is yielded,
+       the body puts the files it wrote in record['outputs'] and sets record['skipped'] if it did nothing"""
+
+    record = {'stage': name, 'skipped': False, 'points': 0, 'outputs': []}
+    reset_peak_rss()
+    OPEN_STAGES.append(record)
+    start = usage()
+    try:
+        yield record
+    finally:
+        OPEN_STAGES.remove(record)
+        finish_stage(record, start, record.pop('outputs'))
+
+
+def timestep_recorder(name_format, points):
+    """return done(i, outputs) which records everything since its previous call (or since now)
+       as stage name_format.format(i) having processed points points.
+       For timesteps that are produced by a generator and finish one after another"""
+
+    reset_peak_rss()
+    last = [usage()]
+
+    def done(i, outputs):
+        finish_stage({'stage': name_format.format(i), 'skipped': False, 'points': points}, last[0], outputs)
+        reset_peak_rss()
+        last[0] = usage()
+
+    return done
+
+
+def write_report(report_name=REPORT_NAME):
+    """write STAGE_REPORT as csv if report_name ends with .csv, as json otherwise"""
+
+    if report_name.endswith('.csv'):
+        with open(report_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(STAGE_REPORT)
+    else:
+        with open(report_name, 'w') as f:
+            json.dump(STAGE_REPORT, f, indent=1)
+    print("wrote " + report_name)
 
 
 # ===================================================================================================================
@@ -47,112 +231,350 @@ def file_counter(file_path, extension):
     return total
 
 
-def extract_xyz(binaryName, endianess):
-    """read a binary file, extract x, y, z of every point,
-       return a list of points with x, y, z"""
+def xyz_dtype(endianess):
+    """return the numpy dtype of one 12-byte binary record (x, y, z as float32)"""
 
-    point_list = []
-    bf = open(binaryName, 'rb')
+    if endianess == 'little':
+        num_format = LITTLE_ENDIAN_FORMAT
+    else:
+        num_format = BIG_ENDIAN_FORMAT
 
-    while bf.tell() < os.fstat(bf.fileno()).st_size:
-        line = bf.read(12)  # read 12 bytes of data (skip spaces)
+    return np.dtype([('x', num_format), ('y', num_format), ('z', num_format)])
 
-        if endianess == 'little':
-            num_format = LITTLE_ENDIAN_FORMAT
-        else:
-            num_format = BIG_ENDIAN_FORMAT
 
-        lx, ly, lz = unpack(num_format, line)
-        point_list.append((lx, ly, lz))
+def map_records(binaryName, endianess):
+    """memory-map a binary file as an array of x, y, z records"""
 
-    bf.close()
+    dtype = xyz_dtype(endianess)
+    if os.path.getsize(binaryName) == 0:  # np.memmap refuses to map empty files
+        return np.empty(0, dtype=dtype)
 
-    return point_list
+    return np.memmap(binaryName, dtype=dtype, mode='r')
 
 
-def create_poly():
-    """create 3 arrrays to store data"""
-    points = vtk.vtkPoints()
-    vertices = vtk.vtkCellArray()
-    zvalues = vtk.vtkFloatArray()
-    return points, vertices, zvalues
-
-
-def insert_value(points, vertices, zvalues, x, y, z):
-    """pumping up the 3 arrays"""
-    id = points.InsertNextPoint(x, y, 0.)
-    vertex = vtk.vtkVertex()
-    vertex.GetPointIds().InsertNextId(id)
-    vertices.InsertNextCell(vertex)
-    zvalues.InsertNextValue(z)
-
-
-def set_poly(points, vertices, zvalues):
-    """set 3 arrays"""
-    polyData = vtk.vtkPolyData()
-    polyData.SetPoints(points)
-    polyData.SetVerts(vertices)
-    polyData.GetPointData().SetScalars(zvalues)
-    return polyData
+def extract_xyz(binaryName, endianess, region=None):
+    """read a binary file, extract x, y, z of every point,
+       return x, y, z as numpy column arrays viewing the mapped file (no copy).
+       With a region (see region_mask) only the points inside it are kept, copied out chunk by chunk"""
+
+    if region is not None:
+        columns = list(zip(*iter_xyz_chunks(binaryName, endianess, region=region))) or \
+            [[np.empty(0, dtype=np.float32)]] * 3
+        return tuple(np.concatenate(column) for column in columns)
+
+    records = map_records(binaryName, endianess)
+
+    return records['x'], records['y'], records['z']
 
 
-def write_poly(polyData, vtpName):
-    """write polyData to a vtp file"""
+def iter_xyz_chunks(binaryName, endianess, chunk_points=CHUNK_POINTS, region=None):
+    """read a binary file chunk_points at a time,
+       yield x, y, z numpy column arrays of every chunk, only the points inside region if there is one.
+       Only one chunk is paged in at a time so files larger than memory can be processed"""
+
+    records = map_records(binaryName, endianess)
+
+    for start in range(0, len(records), chunk_points):
+        chunk = records[start:start + chunk_points]
+        mask = region_mask(chunk['x'], chunk['y'], region)
+        if mask is not None:
+            chunk = chunk[mask]
+        yield chunk['x'], chunk['y'], chunk['z']
+
+
+def write_poly(polyData, vtpName, options=None):
+    """write polyData to a vtp file, encoded as set in options (WRITER_OPTIONS by default).
+       Pool workers are given the options, they may not see what main set in WRITER_OPTIONS"""
+    options = WRITER_OPTIONS if options is None else options
     writer = vtk.vtkXMLPolyDataWriter()
     writer.SetFileName(vtpName)
-    writer.SetInputData(polyData)
+    writer.SetInputData(with_points_precision(polyData, options['precision']))
+    configure_writer(writer, options['encoding'], options['compressor'], options['level'])
     writer.Write()
+    count_points(polyData.GetNumberOfPoints())
 
 
-def read_points(binaryName, endianess):
-    """convert binary points to vtk points"""
+def read_points(binaryName, endianess, region=None):
+    """convert binary points to vtk poly data, only those inside region if there is one,
+       points lie on z = 0 and the z values are kept as scalars"""
 
-    points, vertices, zvalues = create_poly()
-    point_list = extract_xyz(binaryName, endianess)
+    x, y, z = extract_xyz(binaryName, endianess, region)
+    polyData = build_poly(x, y, np.zeros(len(x), dtype=np.float32), z)
 
-    for p in point_list:
-        lx, ly, lz = p
-        insert_value(points, vertices, zvalues, lx, ly, lz)
+    logger.debug("points read")
 
-    print("points read")
+    return polyData
 
-    return (points, vertices, zvalues)
 
+def is_up_to_date(out_name, in_name):
+    """check if out_name exists and is not older than in_name"""
 
-def convert_binary_to_vtp(binaryNamePrefix, endianess, extension, total):
-    """convert binary files to vtp files """
+    return os.path.exists(out_name) and os.path.getmtime(out_name) >= os.path.getmtime(in_name)
 
-    for i in range(total):
-        binaryName = (BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, i)
-        vtpName = CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)
-        points, vertices, zvalues = read_points(binaryName, endianess)
-        polyData = set_poly(points, vertices, zvalues)
-        write_poly(polyData, vtpName)
-        print(vtpName + " converted")
+
+def convert_one_binary(names):
+    """convert a single binary file to a vtp file, chunk_points at a time if it is not None.
+       Written under a temporary name first so an interrupted run never leaves a half-written vtp behind.
+       Return the vtp name and the scalar_sketch of the amplitude"""
+
+    binaryName, endianess, vtpName, chunk_points, writer_options, region = names
+    if chunk_points is None:
+        polyData = read_points(binaryName, endianess, region)
+        write_poly(polyData, vtpName + '.part', writer_options)
+        sketch = scalar_sketch(numpy_support.vtk_to_numpy(polyData.GetPointData().GetScalars()))
+    else:
+        sketch = convert_binary_chunked(binaryName, endianess, vtpName + '.part', chunk_points, region)
+    os.replace(vtpName + '.part', vtpName)
+
+    return vtpName, sketch
+
+
+def convert_binary_to_vtp(binaryNamePrefix, endianess, extension, total, jobs=1, chunk_points=None,
+                          rebuild=False, region=None, frames=None, done=None):
+    """convert binary files to vtp files, keeping only the points inside region if there is one.
+       Only the timesteps listed in frames are converted if it is given, done(i) is called once timestep i
+       is written. Otherwise files whose vtp is newer than the binary are skipped,
+       so an interrupted run resumes where it stopped, unless rebuild is set.
+       jobs > 1 spreads the timesteps over a pool of processes,
+       chunk_points converts every file that many points at a time (see convert_binary_chunked).
+       The amplitude statistics of all timesteps are gathered on the way into SCALAR_STATS_NAME"""
+
+    binaries = [(BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, i) for i in range(total)]
+    if frames is None:
+        frames = []
+        for i in range(total):
+            vtpName = CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)
+            if not rebuild and is_up_to_date(vtpName, binaries[i]):
+                print(vtpName + " up to date")
+            else:
+                frames.append(i)
+    todo = [(binaries[i], endianess, CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i), chunk_points,
+             dict(WRITER_OPTIONS), region) for i in frames]
+    frame_of = {CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i): i for i in frames}
+
+    sketches = {}
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        try:
+            for vtpName, sketch in pool.imap_unordered(convert_one_binary, todo):
+                print(vtpName + " converted")
+                binaryName = binaries[frame_of[vtpName]]
+                count_points(os.path.getsize(binaryName) // xyz_dtype(endianess).itemsize)
+                sketches[binaryName] = sketch
+                if done is not None:
+                    done(frame_of[vtpName])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for names in todo:
+            vtpName, sketches[names[0]] = convert_one_binary(names)
+            print(vtpName + " converted")
+            if done is not None:
+                done(frame_of[vtpName])
+
+    update_scalar_stats(binaries, endianess, sketches, region)
 
 
 # ===================================================================================================================
 # STEP 2: Merge all tiff files together to form a flat terrain
 
+def cross2d(u, v):
+    """z component of the cross product of 2D vectors (or of arrays of them along the last axis)"""
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+
 def sameSide(p1, p2, a, b):
-    """check if 2 points are at the same side of line ab"""
-    cp1 = np.cross(b - a, p1 - a)
-    cp2 = np.cross(b - a, p2 - a)
+    """check if 2 points (or arrays of points) are at the same side of line ab"""
+    cp1 = cross2d(b - a, p1 - a)
+    cp2 = cross2d(b - a, p2 - a)
     return (cp1 * cp2 >= 0)
 
 
 def insideTriangle(p, a, b, c):
-    """check if a point p is inside the triangle abc"""
-    return sameSide(p, a, b, c) and sameSide(p, b, a, c) and sameSide(p, c, a, b)
+    """check if a point p (or every point of an array p) is inside the triangle abc"""
+    return sameSide(p, a, b, c) & sameSide(p, b, a, c) & sameSide(p, c, a, b)
 
 
 def insideRectangle(p, a, b, c, d):
-    """check if a point p is inside the rectangle abcd"""
-    return insideTriangle(p, a, b, c) or insideTriangle(p, c, d, a)
+    """check if a point p (or every point of an array p) is inside the rectangle abcd"""
+    return insideTriangle(p, a, b, c) | insideTriangle(p, c, d, a)
+
+
+def inside_polygon(xx, yy, polygon):
+    """even-odd test of the points xx, yy against a polygon given as an n x 2 array of corners,
+       one vectorised pass over the points per edge"""
+
+    inside = np.zeros(len(xx), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y0 > yy) != (y1 > yy)
+        x_at = x0 + (yy - y0) * (x1 - x0) / np.where(crosses, y1 - y0, 1.)
+        inside ^= crosses & (xx < x_at)
+
+    return inside
+
+
+def region_mask(xx, yy, region, margin=0.):
+    """return a boolean mask of the points xx, yy inside region, a list of x, y corners,
+       or None if region is None (the whole domain).
+       With a margin only the bounding box of the region grown by margin is tested,
+       the terrain is cut that way so amplitude points at the edge of the region still lie on it"""
+
+    if region is None:
+        return None
+    polygon = np.asarray(region, dtype=np.float64)
+    (xmin, ymin), (xmax, ymax) = polygon.min(axis=0) - margin, polygon.max(axis=0) + margin
+
+    mask = (xmin <= xx) & (xx <= xmax) & (ymin <= yy) & (yy <= ymax)
+    if not margin:
+        mask[mask] = inside_polygon(xx[mask], yy[mask], polygon)
+
+    return mask
+
+
+def box_polygon(xmin, ymin, xmax, ymax):
+    """corners of a bounding box as a region polygon"""
+
+    return [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]]
+
+
+def crop_mask(xx, yy, crop):
+    """return a boolean mask of the points xx, yy lying inside the quadrilateral crop=[v0,v1,v2,v3]"""
+
+    assert len(crop) == 4
+    v0, v1, v2, v3 = [np.asarray(v, dtype=float) for v in crop]
+
+    mask = (v0[0] <= xx) & (xx <= v2[0]) & (v3[1] <= yy) & (yy <= v1[1])
+    mask[mask] = insideRectangle(np.column_stack((xx[mask], yy[mask])), v0, v1, v2, v3)
+
+    return mask
+
+
+def reduce_block(block, factor, method):
+    """reduce every factor x factor pixels of block to one value.
+       nearest keeps the top-left pixel, average ignores sea pixels, max keeps the highest pixel"""
+
+    if method == 'nearest':
+        return block[::factor, ::factor]
+
+    rows = -(-block.shape[0] // factor)
+    cols = -(-block.shape[1] // factor)
+    padded = np.full((rows * factor, cols * factor), np.nan)  # pad partial edge blocks with nan
+    padded[:block.shape[0], :block.shape[1]] = block
+    blocks = padded.reshape(rows, factor, cols, factor)
+
+    if method == 'max':
+        return np.where(np.isnan(blocks), IN_SEA, blocks).max(axis=(1, 3))
+
+    land = ~np.isnan(blocks) & (blocks != IN_SEA)
+    total = np.where(land, blocks, 0.).sum(axis=(1, 3))
+    count = land.sum(axis=(1, 3))
+    return np.where(count > 0, total / np.maximum(count, 1), IN_SEA)
+
+
+def read_decimated_levels(band, factors, method='nearest', block_rows=READ_BLOCK_ROWS):
+    """read a raster band once, reduced by every factor in factors in both directions.
+       Return one array per factor. The band is read in windows of about block_rows * min(factors) rows,
+       rounded up to a multiple of every factor so each window reduces to whole rows at every level"""
+
+    assert method in RESAMPLE_METHODS
+
+    factors = [int(factor) for factor in factors]
+    step = int(np.lcm.reduce(factors))
+    window = step * -(-block_rows * min(factors) // step)
+    width, height = band.XSize, band.YSize
+    outs = [np.empty((-(-height // factor), -(-width // factor))) for factor in factors]
+
+    for y_off in range(0, height, window):
+        block = band.ReadAsArray(0, y_off, width, min(window, height - y_off)).astype(np.float64)
+        for factor, out in zip(factors, outs):
+            reduced = reduce_block(block, factor, method)
+            out[y_off // factor:y_off // factor + len(reduced)] = reduced
+
+    return outs
+
+
+def cell_errors(z, size):
+    """split grid z (shape a multiple of size plus 1) into size x size cells,
+       return the largest vertical error over each cell (edges included) when the cell
+       is replaced by two triangles between its corners, whichever diagonal they are split along"""
+
+    n_rows, n_cols = (z.shape[0] - 1) // size, (z.shape[1] - 1) // size
+    corners = z[::size, ::size]
+
+    # cell of every grid point and where the point lies in it, the last row/column belongs to the last cell
+    cell_row = np.minimum(np.arange(z.shape[0]) // size, n_rows - 1)
+    cell_col = np.minimum(np.arange(z.shape[1]) // size, n_cols - 1)
+    u = ((np.arange(z.shape[0]) - cell_row * size) / size)[:, None]
+    v = ((np.arange(z.shape[1]) - cell_col * size) / size)[None, :]
+    a = corners[cell_row][:, cell_col]           # (0, 0) corner
+    b = corners[cell_row][:, cell_col + 1]       # (0, 1) corner
+    c = corners[cell_row + 1][:, cell_col]       # (1, 0) corner
+    d = corners[cell_row + 1][:, cell_col + 1]   # (1, 1) corner
+
+    split_ad = np.where(u >= v, a + u * (c - a) + v * (d - c), a + v * (b - a) + u * (d - b))
+    split_bc = np.where(u + v <= 1, a + u * (c - a) + v * (b - a), d + (1 - u) * (b - d) + (1 - v) * (c - d))
+    error = np.maximum(np.abs(z - split_ad), np.abs(z - split_bc))
+
+    # every cell owns its top and left edges, its bottom and right edges are owned by the next cells
+    inner = error[:-1, :-1].reshape(n_rows, size, n_cols, size).max(axis=(1, 3))
+    bottom = error[size::size, :-1].reshape(n_rows, n_cols, size).max(axis=2)
+    right = error[:-1, size::size].reshape(n_rows, size, n_cols).max(axis=1)
+
+    return np.maximum(inner, np.maximum(bottom, right))
+
+
+def quadtree_keep(z, tolerance, max_block=ADAPTIVE_MAX_BLOCK):
+    """adaptive decimation of grid z: return a boolean mask of the points to keep.
+       Cells of a quadtree, from max_block points wide down to 1, are collapsed to their corners
+       as soon as two triangles between the corners stay within tolerance of every point of the cell.
+       Flat ground ends up with few large cells, rough ground keeps every point.
+       The delaunay of step 5 does not always split cells along their corners, so a few points
+       (well under 0.1% on test terrain) end up to about twice tolerance away from the surface"""
+
+    assert max_block & (max_block - 1) == 0, "max_block must be a power of 2"
+
+    n_rows, n_cols = z.shape
+    if n_rows < 2 or n_cols < 2:  # no cell to collapse
+        return np.ones(z.shape, dtype=bool)
+    padded = np.pad(z, ((0, -(-n_rows // max_block) * max_block + 1 - n_rows),
+                        (0, -(-n_cols // max_block) * max_block + 1 - n_cols)), mode='edge')
+    keep = np.zeros(padded.shape, dtype=bool)
+
+    covered = None  # cells already collapsed into a larger cell
+    size = max_block
+    while size >= 1:
+        cells_r, cells_c = (padded.shape[0] - 1) // size, (padded.shape[1] - 1) // size
+        if covered is None:
+            covered = np.zeros((cells_r, cells_c), dtype=bool)
+        else:
+            covered = np.repeat(np.repeat(covered, 2, axis=0), 2, axis=1)
+
+        # cells reaching into the padding are split until they are single points
+        inside = (((np.arange(cells_r) + 1) * size <= n_rows - 1)[:, None] &
+                  ((np.arange(cells_c) + 1) * size <= n_cols - 1)[None, :])
+        # every point of z is a corner of an inside cell of size 1
+        leaf = inside & ~covered
+        if size > 1:
+            leaf &= cell_errors(padded, size) <= tolerance
+
+        grid = keep[::size, ::size]  # corners of the cells of this size, a view into keep
+        grid[:-1, :-1] |= leaf
+        grid[:-1, 1:] |= leaf
+        grid[1:, :-1] |= leaf
+        grid[1:, 1:] |= leaf
+
+        covered |= leaf
+        size //= 2
 
+    return keep[:n_rows, :n_cols]
 
-def geotiff2vtp(gtifName, crop=None):
-    """convert tiff file to vtp file every 10 points"""
+
+def geotiff2xyz(gtifName, crop=None, resample='nearest', tolerance=None, region=None):
+    """convert tiff file to x, y, z numpy arrays of every COUNTER_FACTOR points.
+       resample is one of RESAMPLE_METHODS.
+       With a tolerance (metres) those points are further thinned by quadtree_keep,
+       keeping detail only where the terrain is rough"""
 
     # If crop is desired, provide 4 cordinates of corners
     # v0=np.array([171.322525,-43.174225])
@@ -161,123 +583,331 @@ def geotiff2vtp(gtifName, crop=None):
     # v3=np.array([171.565277,-44.233200])
     # then call geotiff2vtp with crop=[v0,v1,v2,v3]
 
-    if crop is not None:
-        assert len(crop) == 4
-        v0, v1, v2, v3 = crop
+    return geotiff2xyz_levels(gtifName, (COUNTER_FACTOR,), crop, resample, tolerance, region)[0]
+
 
-    points, vertices, zvalues = create_poly()
-    zvalues.SetName('Elevation')
+def geotiff2xyz_levels(gtifName, factors, crop=None, resample='nearest', tolerance=None, region=None):
+    """convert tiff file to x, y, z numpy arrays of every factor points for every factor in factors,
+       reading the tif once. Return a list of x, y, z, one per factor"""
 
     ds = gdal.Open(gtifName)
-    dsA = ds.ReadAsArray()
     gt = ds.GetGeoTransform()
 
-    y_counter = 0
-    for y in range(len(dsA)):
-        x_counter = 0
-        for x in range(len(dsA[y])):
-            xx = gt[0] + gt[1] * x      # g[0] is xOrigin, gt[1] is pixelWidth
-            yy = gt[3] + gt[5] * y      # g[3] is yOrigin, gt[5] is pixelHeight
-            z = dsA[y][x]
-            if z == IN_SEA:
-                z = -0.1
-                zz = -0.001
-            else:
-                zz = z / ZZ_DIVISION_FACTOR
+    # reduce resolution to 1/100, otherwise too much computation
+    levels = read_decimated_levels(ds.GetRasterBand(1), factors, resample)
+
+    return [decimated_xyz(z, gt, factor, crop, tolerance, region) for z, factor in zip(levels, factors)]
+
 
-            # reduce resolution to 1/100, otherwise too much computation
-            if y_counter % COUNTER_FACTOR == 0 and x_counter % COUNTER_FACTOR == 0:
+def decimated_xyz(z, gt, factor, crop=None, tolerance=None, region=None):
+    """place grid z, read every factor pixels of a tif with geotransform gt,
+       return its x, y, z numpy arrays with the sea flattened and z scaled down.
+       With a region only the points in its bounding box, grown by one terrain cell, are kept"""
 
-                if crop is None or (v0[0] <= xx <= v2[0] and v3[1] <= yy <= v1[1] and insideRectangle(
-                        np.array([xx, yy]), v0, v1, v2, v3)):
-                    insert_value(points, vertices, zvalues, xx, yy, zz)
-            x_counter += 1
-        y_counter += 1
+    cols = np.arange(z.shape[1]) * factor
+    rows = np.arange(z.shape[0]) * factor
+    xx, yy = np.meshgrid(gt[0] + gt[1] * cols,   # g[0] is xOrigin, gt[1] is pixelWidth
+                         gt[3] + gt[5] * rows)   # g[3] is yOrigin, gt[5] is pixelHeight
+    zz = np.where(z == IN_SEA, -0.001, z / ZZ_DIVISION_FACTOR)
 
-    polyData = set_poly(points, vertices, zvalues)
+    if tolerance is None:
+        xx, yy, zz = xx.ravel(), yy.ravel(), zz.ravel()
+    else:
+        keep = quadtree_keep(zz, tolerance / ZZ_DIVISION_FACTOR)
+        xx, yy, zz = xx[keep], yy[keep], zz[keep]
+    if crop is not None:
+        mask = crop_mask(xx, yy, crop)
+        xx, yy, zz = xx[mask], yy[mask], zz[mask]
+    mask = region_mask(xx, yy, region, factor * max(abs(gt[1]), abs(gt[5])))
+    if mask is not None:
+        xx, yy, zz = xx[mask], yy[mask], zz[mask]
+
+    return xx, yy, zz
+
+
+def raster_triangles(tiles):
+    """triangles of terrain points read from tifs on one raster, given as a list of x, y, z per tile.
+       Every point is placed on the lattice of the raster by its coordinates, so cells are
+       stitched across the seams of neighbouring tiles, and every lattice cell with its
+       four corners present becomes two triangles, without a delaunay.
+       Return an n x 3 array of ids into the concatenated points, or None if the points are not
+       on one lattice (cropped, adaptive, misaligned or overlapping tiles) or the cells found
+       leave holes in it, as tiles whose width is not a multiple of the decimation do"""
+
+    xx = np.concatenate([tile[0] for tile in tiles]) if tiles else np.empty(0)
+    yy = np.concatenate([tile[1] for tile in tiles]) if tiles else np.empty(0)
+
+    def lattice_index(values):
+        unique = np.unique(values)
+        if len(unique) < 2:
+            return None
+        step = np.diff(unique).min()
+        index = np.rint((values - unique[0]) / step)
+        if np.abs(unique[0] + index * step - values).max() > 1e-3 * step:
+            return None
+        return index.astype(np.int64)
+
+    if len(xx) < 4:
+        return None
+    cols, rows = lattice_index(xx), lattice_index(yy)
+    if cols is None or rows is None or (cols.max() + 1) * (rows.max() + 1) > 4 * len(xx):
+        return None
+    grid = np.full((rows.max() + 1, cols.max() + 1), -1, dtype=np.int64)
+    grid[rows, cols] = np.arange(len(xx))
+    if np.count_nonzero(grid >= 0) < len(xx):
+        return None  # tiles overlap
+
+    a, b, c, d = grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]
+    full = (a >= 0) & (b >= 0) & (c >= 0) & (d >= 0)
+    a, b, c, d = a[full], b[full], c[full], d[full]
+    # a whole lattice of n points on R rows and C columns has n - R - C + 1 cells,
+    # two or more of them missing means holes
+    if len(a) < len(xx) - grid.shape[0] - grid.shape[1]:
+        return None
+
+    return np.concatenate((np.column_stack((a, b, c)), np.column_stack((a, c, d))))
+
+
+def geotiff2vtp(gtifName, crop=None, resample='nearest', tolerance=None, cells=False, region=None):
+    """convert tiff file to vtp file every COUNTER_FACTOR points.
+       resample is one of RESAMPLE_METHODS, tolerance and region as in geotiff2xyz.
+       With cells the raster cells of the tif are added as triangles (see raster_triangles)"""
+
+    xx, yy, zz = geotiff2xyz(gtifName, crop, resample, tolerance, region)
+    polyData = build_poly(xx, yy, np.zeros(len(xx)), zz, 'Elevation')
+    triangles = raster_triangles([(xx, yy, zz)]) if cells and crop is None and tolerance is None else None
+    if triangles is not None:
+        polyData.SetPolys(build_triangles(triangles))
     return polyData
 
 
-def append_vtps(tifiles):
+def geotiff2xyz_worker(args):
+    """unpack arguments of geotiff2xyz_levels for a process pool"""
+
+    logger.debug(args[0])
+    return geotiff2xyz_levels(*args)
+
+
+def terrain_cache_key(gtifs, crop, resample, tolerance=None, region=None):
+    """hash everything the flat terrain depends on: tile paths and mtimes, decimation, crop and resampling,
+       and the WRITER_OPTIONS its cached vtp files are written with"""
+
+    key = {
+        'tiles': [(os.path.abspath(name), os.path.getmtime(name)) for name in gtifs],
+        'counter_factor': COUNTER_FACTOR,
+        'zz_division_factor': ZZ_DIVISION_FACTOR,
+        'crop': None if crop is None else [[float(c) for c in v] for v in crop],
+        'resample': resample,
+        'tolerance': tolerance,
+        'adaptive_max_block': ADAPTIVE_MAX_BLOCK,
+        'mesh_version': TERRAIN_MESH_VERSION,
+        'region': region,
+        'writer': WRITER_OPTIONS,
+    }
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def terrain_level_names(factor):
+    """return the flat and the elevated terrain names of the level of detail of factor.
+       The level of COUNTER_FACTOR is the terrain itself"""
+
+    if factor == COUNTER_FACTOR:
+        return FLAT_TERRAIN_NAME, ElEVATED_TERRAIN_NAME
+
+    return FLAT_TERRAIN_LOD_FORMAT.format(factor), ELEVATED_TERRAIN_LOD_FORMAT.format(factor)
+
+
+def terrain_outputs(lod_factors=()):
+    """return (vtp name, factor) of the flat terrain and of every other level of detail"""
+
+    return [(FLAT_TERRAIN_NAME, COUNTER_FACTOR)] + [(terrain_level_names(factor)[0], factor)
+                                                    for factor in sorted(set(lod_factors) - {COUNTER_FACTOR})]
+
+
+def append_vtps(tifiles, resample='nearest', crop=None, jobs=1, cache_dir=TERRAIN_CACHE_DIR, tolerance=None,
+                lod_factors=(), region=None):
     """append vtp files converted from geotiff
-       together to show the merged flat terrain"""
+       together to show the merged flat terrain.
+       Tiles are converted by jobs processes and merged once.
+       tolerance (metres) turns on the adaptive decimation of geotiff2xyz, region cuts the terrain around it.
+       Every factor in lod_factors other than COUNTER_FACTOR also gets a flat terrain of its own
+       (FLAT_TERRAIN_LOD_FORMAT), from the same single read of every tile.
+       A whole terrain carries the raster cells stitched across tiles (raster_triangles),
+       so step 5 needs no delaunay.
+       The result is cached in cache_dir so later runs on the same tiles reuse it.
+       Return the names of the flat terrain files"""
+
+    gtifs = sorted(glob.glob(tifiles))
+    outputs = terrain_outputs(lod_factors)
+
+    cached_names = None
+    if cache_dir is not None:
+        key = terrain_cache_key(gtifs, crop, resample, tolerance, region)
+        cached_names = [os.path.join(cache_dir, key + ('.vtp' if vtpName == FLAT_TERRAIN_NAME else
+                                                       '_lod{:02d}.vtp'.format(factor)))
+                        for vtpName, factor in outputs]
+        if all(os.path.exists(cached_name) for cached_name in cached_names):
+            for (vtpName, factor), cached_name in zip(outputs, cached_names):
+                shutil.copyfile(cached_name, vtpName)
+                print("reused cached " + cached_name)
+            return [vtpName for vtpName, _ in outputs]
+
+    factors = sorted(set(factor for _, factor in outputs))
+    tasks = [(gtifName, factors, crop, resample, tolerance, region) for gtifName in gtifs]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            tiles = pool.map(geotiff2xyz_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tiles = [geotiff2xyz_worker(task) for task in tasks]
+
+    for vtpName, factor in outputs:
+        level = [tile[factors.index(factor)] for tile in tiles]
+        if level:
+            xx, yy, zz = [np.concatenate(column) for column in zip(*level)]
+        else:
+            xx = yy = zz = np.empty(0)
+        appendData = build_poly(xx, yy, np.zeros(len(xx)), zz, 'Elevation')
+        triangles = raster_triangles(level) if crop is None and tolerance is None else None
+        if triangles is not None:
+            appendData.SetPolys(build_triangles(triangles))
+        write_poly(appendData, vtpName)
+
+    if cached_names is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for (vtpName, factor), cached_name in zip(outputs, cached_names):
+            shutil.copyfile(vtpName, cached_name + '.part')
+            os.replace(cached_name + '.part', cached_name)
 
-    appender = vtk.vtkAppendPolyData()
-    gtifs = glob.glob(tifiles)
-    for gtifName in gtifs:
-        print(gtifName)
-        polyData = geotiff2vtp(gtifName, crop=None)
-        appender.AddInputData(polyData)
-        appender.Update()
-    appendData = appender.GetOutput()
-    write_poly(appendData, FLAT_TERRAIN_NAME)
+    return [vtpName for vtpName, _ in outputs]
 
 
 # ===================================================================================================================
 # STEP 3: Form the boundary of the region extracted from our earthquake data
 
+def lexicographic_extreme(x, y, largest=False):
+    """return the index of the smallest (or largest) point ordered by x then y, in linear time"""
+
+    if largest:
+        candidates = np.flatnonzero(x == x.max())
+        return candidates[np.argmax(y[candidates])]
+
+    candidates = np.flatnonzero(x == x.min())
+    return candidates[np.argmin(y[candidates])]
+
+
 def find_boundary(point_list):
-    """take a point list, return the four boundary points.
-       x is the longitude, y is the latitude"""
+    """take a point list (or an n x 2 array of points), return the four boundary points.
+       x is the longitude, y is the latitude.
+       Found with argmin/argmax in linear time, ties are broken the same way sorting the points did"""
 
-    sorted_x = sorted(point_list)
-    sorted_y = sorted(point_list, key=lambda x: x[1])
+    points = np.asarray(point_list)
+    x, y = points[:, 0], points[:, 1]
 
-    x_min = (sorted_x[0])
-    x_max = (sorted_x[-1])
-    y_min = (sorted_y[0])
-    y_max = (sorted_y[-1])
+    x_min = tuple(points[lexicographic_extreme(x, y)].tolist())
+    x_max = tuple(points[lexicographic_extreme(x, y, largest=True)].tolist())
+    y_min = tuple(points[np.argmin(y)].tolist())
+    y_max = tuple(points[len(y) - 1 - np.argmax(y[::-1])].tolist())  # last of the highest points
 
-    print(x_min, x_max, y_min, y_max)
+    logger.debug("extremes %s %s %s %s", x_min, x_max, y_min, y_max)
     return x_min, x_max, y_min, y_max
 
 
+def extreme_polygon(points):
+    """return the points extreme in the 8 directions x, x+y, y, y-x, -x, -x-y, -y, x-y,
+       in counter-clockwise order without repeats. Every one of them lies on the convex hull"""
+
+    x, y = points[:, 0], points[:, 1]
+    indices = [np.argmax(x), np.argmax(x + y), np.argmax(y), np.argmax(y - x),
+               np.argmin(x), np.argmin(x + y), np.argmin(y), np.argmax(x - y)]
+
+    polygon = []
+    for i in indices:
+        if not polygon or (points[i] != polygon[-1]).any():
+            polygon.append(points[i])
+    if len(polygon) > 1 and (polygon[0] == polygon[-1]).all():
+        polygon.pop()
+
+    return np.array(polygon)
+
+
+def convex_hull(point_list):
+    """take a point list (or an n x 2 array of points), return its convex hull counter-clockwise.
+       Points strictly inside the polygon of extreme points are dropped first with one vectorized test,
+       so the monotone chain only sorts the thin band of points near the boundary"""
+
+    points = np.asarray(point_list, dtype=float)[:, :2]
+
+    polygon = extreme_polygon(points)
+    if len(polygon) >= 3:
+        inside = np.ones(len(points), dtype=bool)
+        for a, b in zip(polygon, np.roll(polygon, -1, axis=0)):
+            inside &= cross2d(b - a, points - a) > 0
+        points = points[~inside]
+
+    # float32 coordinates of a straight edge are not exactly collinear, treat tiny turns as straight
+    tolerance = 1e-6 * np.ptp(points, axis=0).max() ** 2 if len(points) else 0.
+    points = points[np.lexsort((points[:, 1], points[:, 0]))].tolist()
+
+    def half_hull(sorted_points):
+        hull = []
+        for p in sorted_points:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1]) -
+                                      (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= tolerance:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    lower = half_hull(points)
+    upper = half_hull(reversed(points))
+
+    return [tuple(p) for p in lower[:-1] + upper[:-1]]
+
+
 def approx_drawing_distance(a, b):
     """calc distance between point a and b"""
     dis = sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2)
     return dis
 
 
-def calc_points(start, end, number_of_points):
-    """Take start and end points of a line, write the start point up to but
-       not include the end point as polydata according to number_of_points"""
+def line_points(starts, ends, number_of_points):
+    """Take start and end points of a line (or n x 2 arrays of them for many lines),
+       return x, y of the start point up to but not including the end point
+       of every line according to number_of_points, one line after another"""
+
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
 
     gaps = number_of_points - 1
     if gaps == 0 or gaps == -1:
         gaps = 3
-    print("number of gaps", gaps)
 
-    lon_gap = abs(float(start[0] - end[0]) / gaps)
-    lat_gap = abs(float(start[1] - end[1]) / gaps)
+    steps = np.arange(max(number_of_points - 1, 0))
+    gap = (ends - starts) / gaps
+    x = starts[:, :1] + gap[:, :1] * steps
+    y = starts[:, 1:] + gap[:, 1:] * steps
 
-    if start[1] > end[1]:  # to ensure the direction of a line is correct
-        lat_gap = -lat_gap
-    if start[0] > end[0]:
-        lon_gap = -lon_gap
-    print("long gap", lon_gap, "lat gap", lat_gap)
+    return x.ravel(), y.ravel()
 
-    appender = vtk.vtkAppendPolyData()
-    points, vertices, zvalues = create_poly()
 
-    i = 0
-    while i < (number_of_points - 1):
-        x, y = start
-        insert_value(points, vertices, zvalues, x, y, 0.)
-        start = (start[0] + lon_gap, start[1] + lat_gap)
-        i += 1
-    poly_data = set_poly(points, vertices, zvalues)
-    appender.AddInputData(poly_data)
-    appender.Update()
-    appender_data = appender.GetOutput()
+def xy_to_poly(x, y):
+    """take x, y arrays, return them as polydata of points on z = 0"""
 
-    return appender_data
+    zeros = np.zeros(len(x))
+    return build_poly(x, y, zeros, zeros)
 
 
-def form_boundary(point_list, number_of_points, out_name=None):
-    """take a point list, return points along the boundaries as polydata"""
+def boundary_lines(point_list, number_of_points):
+    """take a point list, return x, y arrays of the four lines
+       x_min -> y_max -> x_max -> y_min -> x_min along its boundary"""
 
     x_min, x_max, y_min, y_max = find_boundary(point_list)
-    print("four cornoer is", x_min, x_max, y_min, y_max)
+    logger.debug("four cornoer is %s %s %s %s", x_min, x_max, y_min, y_max)
 
     # approximate distance between connected boundary points.
     # For accuracy you may want to use https://en.wikipedia.org/wiki/Geographical_distance
@@ -286,7 +916,7 @@ def form_boundary(point_list, number_of_points, out_name=None):
     dis_xmax_ymin = approx_drawing_distance(x_max[:2], y_min[:2])
     dis_ymin_xmin = approx_drawing_distance(y_min[:2], x_min[:2])
 
-    print(dis_xmin_ymax, dis_xmax_ymax, dis_xmax_ymin, dis_ymin_xmin)
+    logger.debug("line lengths %s %s %s %s", dis_xmin_ymax, dis_xmax_ymax, dis_xmax_ymin, dis_ymin_xmin)
 
     factor_1 = float(dis_xmax_ymax / dis_xmin_ymax)
     factor_2 = float(dis_xmax_ymin / dis_xmin_ymax)
@@ -296,98 +926,128 @@ def form_boundary(point_list, number_of_points, out_name=None):
     n2 = round(number_of_points * factor_2)
     n3 = round(number_of_points * factor_3)
 
-    appender = vtk.vtkAppendPolyData()
-    poly_data1 = calc_points(x_min[:2], y_max[:2], number_of_points)
-    print(number_of_points)
-    appender.AddInputData(poly_data1)
-    appender.Update()
+    corners = [x_min[:2], y_max[:2], x_max[:2], y_min[:2], x_min[:2]]
+    counts = [number_of_points, n1, n2, n3]
+
+    return [line_points(start, end, n) for start, end, n in zip(corners, corners[1:], counts)]
+
+
+def form_boundary(point_list, number_of_points, out_name=None):
+    """take a point list, return points along the boundaries as polydata"""
 
-    poly_data2 = calc_points(y_max[:2], x_max[:2], n1)
-    appender.AddInputData(poly_data2)
-    appender.Update()
+    lines = boundary_lines(point_list, number_of_points)
+    x = np.concatenate([line[0] for line in lines])
+    y = np.concatenate([line[1] for line in lines])
 
-    poly_data3 = calc_points(x_max[:2], y_min[:2], n2)
-    appender.AddInputData(poly_data3)
-    appender.Update()
+    poly_data = xy_to_poly(x, y)
+    if out_name is not None:
+        write_poly(poly_data, out_name)
 
-    poly_data4 = calc_points(y_min[:2], x_min[:2], n3)
-    appender.AddInputData(poly_data4)
-    appender.Update()
+    return poly_data
 
-    appender_data = appender.GetOutput()
+
+def form_hull_boundary(point_list, number_of_points, out_name=None):
+    """take a point list, return points along its convex hull as polydata.
+       Spacing matches form_boundary: number_of_points along the line between the x_min and y_max points"""
+
+    hull = convex_hull(point_list)
+    x_min, x_max, y_min, y_max = find_boundary(point_list)
+    reference = approx_drawing_distance(x_min[:2], y_max[:2])
+    logger.debug("convex hull has %s corners", len(hull))
+
+    xs, ys = [], []
+    for start, end in zip(hull, hull[1:] + hull[:1]):
+        n = max(int(round(number_of_points * approx_drawing_distance(start, end) / reference)), 2)
+        x, y = line_points(start, end, n)
+        xs.append(x)
+        ys.append(y)
+
+    poly_data = xy_to_poly(np.concatenate(xs), np.concatenate(ys))
     if out_name is not None:
-        write_poly(appender_data, out_name)
+        write_poly(poly_data, out_name)
+
+    return poly_data
+
+
+def write_boundary(point_list, number_of_points, method='corners'):
+    """write the boundary of point_list to BOUNDARY_FILENAME, through its 4 extreme points (corners, form_boundary)
+       or along its convex hull (hull, form_hull_boundary). Return the files written"""
 
-    return poly_data1, poly_data2, poly_data3, poly_data4, appender_data  # to compute filled faults
+    if method == 'hull':
+        form_hull_boundary(point_list, number_of_points, BOUNDARY_FILENAME)
+    else:
+        form_boundary(point_list, number_of_points, BOUNDARY_FILENAME)
+
+    return [BOUNDARY_FILENAME]
 
 
 # ===================================================================================================================
 # STEP 4: Form the faults that raptures during the earthquake
 
-def form_planes(fault_data_txt, number_of_points):
-    """Read a fault-data txt, extract planes/faults'boundarie points,
-       Then fill the planes/faults with points and write out as vtp files"""
+def read_fault_planes(fault_data_txt):
+    """Read a fault-data txt, return the four corner points (lon, lat) of every plane/fault.
+       The first two lines are about the hypocentre. After that every plane is
+       a header line followed by its corners, one 'lon lat' per line"""
 
     with open(fault_data_txt, 'r') as f:
         plane_info = f.readlines()[2:]  # skip the first two line as info are about the hypercentre
-        i = 0         # trace line
-        count = 0     # trace plane
-        while i <= len(plane_info):
-            if i % 5 != 0:
-                lon, lat = plane_info[i].split()
-                lon = float(lon)
-                lat = float(lat)
-                point = (lon, lat)
-                print("xyis", lon, lat)
-                plane_boundary.append(point)
-
-            elif i == 0:
-                plane_boundary = []
 
-            else:
-                appender = vtk.vtkAppendPolyData()
-                poly_data1, poly_data2, poly_data3, poly_data4, whole_data = form_boundary(plane_boundary,
-                                                                                           number_of_points)
-                print("write rect boundary")
-                # add boundary lines first.
-                # Alternatively you could add the four boundary points to avoid repeated insertion of start points in the loop below.
-                appender.AddInputData(whole_data)
-                appender.Update()
-
-                points1 = poly_data1.GetPoints()
-                points2 = poly_data2.GetPoints()
-                points3 = poly_data3.GetPoints()
-                points4 = poly_data4.GetPoints()
-
-                total1 = points1.GetNumberOfPoints()
-                total2 = points2.GetNumberOfPoints()
-                total3 = points3.GetNumberOfPoints()
-                total4 = points4.GetNumberOfPoints()
-
-                # fill a rectangle by computing lines between opposite points on the boundary
-                for j in range(1, int(min(total1, total3))):
-                    print("total 1", total1, "total 3", total3)
-                    start = points1.GetPoint(j)
-                    print("line 1 pos ", j)
-                    print("sssssssstart", start)
-                    end = points3.GetPoint(int(min(total1, total3) - j))
-                    print("line 3 pos  ", (int(min(total1, total3) - j)))
-                    print("eeeeeeeeeend", end)
-                    lines_num = min(total2, total4)
-                    if lines_num == 0:
-                        print("lines_num == 0000000000000000000000000000000000000000000000")
-                        lines_num = 4
-                    line = calc_points(start[:2], end[:2], FILL_FAULTS_FACTOR * lines_num)
-                    print("rectangle", count, "plot line from ", start, "to ", end, "number of points is", (FILL_FAULTS_FACTOR * lines_num))
-                    appender.AddInputData(line)
-                    appender.Update()
-
-                plane_boundary = []
-                appender_data = appender.GetOutput()
-                write_poly(appender_data, FAULT_DATA_FORMAT.format(count))
-                count += 1
-            i += 1
-            print("count is", count - 1)
+    planes = []
+    corners = []
+    for line in plane_info + ['']:  # the extra empty line closes the last plane
+        try:
+            point = tuple(float(value) for value in line.split())
+        except ValueError:
+            point = ()
+
+        if len(point) == 2:
+            corners.append(point)
+        elif corners:
+            assert len(corners) % 4 == 0, "a plane needs four corners"
+            planes.extend(corners[k:k + 4] for k in range(0, len(corners), 4))
+            corners = []
+
+    return planes
+
+
+def fill_plane(corners, number_of_points):
+    """take the four corners of a plane, return x, y arrays of its boundary lines
+       followed by lines between opposite points of boundary lines 1 and 3,
+       i.e. a bilinear grid of points spanning the plane"""
+
+    lines = boundary_lines(corners, number_of_points)
+    (x1, y1), (x2, y2), (x3, y3), (x4, y4) = lines
+
+    lines_num = min(len(x2), len(x4))
+    if lines_num == 0:
+        lines_num = 4
+
+    # fill a rectangle by computing lines between opposite points on the boundary
+    total = min(len(x1), len(x3))
+    j = np.arange(1, total)
+    starts = np.column_stack((x1[j], y1[j]))
+    ends = np.column_stack((x3[total - j], y3[total - j]))
+    fill_x, fill_y = line_points(starts, ends, FILL_FAULTS_FACTOR * lines_num)
+
+    x = np.concatenate([line[0] for line in lines] + [fill_x])
+    y = np.concatenate([line[1] for line in lines] + [fill_y])
+
+    return x, y
+
+
+def form_planes(fault_data_txt, number_of_points):
+    """Read a fault-data txt, extract planes/faults'boundarie points,
+       Then fill the planes/faults with points and write out as vtp files.
+       Return the vtp files written, one per plane"""
+
+    planes = read_fault_planes(fault_data_txt)
+
+    for count, corners in enumerate(planes):
+        x, y = fill_plane(corners, number_of_points)
+        write_poly(xy_to_poly(x, y), FAULT_DATA_FORMAT.format(count))
+        print("wrote " + FAULT_DATA_FORMAT.format(count))
+
+    return [FAULT_DATA_FORMAT.format(count) for count in range(len(planes))]
 
 
 # ===================================================================================================================
@@ -407,15 +1067,35 @@ def read_poly_data(vtpName):
 def create_delaunay(poly_data):
     """create 2D delunay"""
 
-    print("starting delaunay")
+    logger.debug("starting delaunay")
     delaunay = vtk.vtkDelaunay2D()
-    print("ending delaunay")
+    logger.debug("ending delaunay")
     delaunay.SetInputData(poly_data)
     delaunay.Update()
 
     return delaunay
 
 
+def terrain_surface(poly_data):
+    """the triangulated flat terrain, used as the probe source and warped into the elevated terrain:
+       the raster cells the terrain was written with in step 2 when it has them,
+       a delaunay of its points otherwise (cropped or adaptive terrains)"""
+
+    if not poly_data.GetNumberOfPolys():
+        return create_delaunay(poly_data)
+
+    surface = vtk.vtkPolyData()
+    surface.SetPoints(poly_data.GetPoints())
+    surface.SetPolys(poly_data.GetPolys())
+    surface.GetPointData().ShallowCopy(poly_data.GetPointData())
+
+    pass_through = vtk.vtkPassThrough()
+    pass_through.SetInputData(surface)
+    pass_through.Update()
+
+    return pass_through
+
+
 def create_probe_filter(source_delaunay, input_poly_data):
     """return a vtk probe filter for amplitude warp scalar.
     Source_delaunay is the data set that will be probed at the input points.
@@ -441,6 +1121,212 @@ def create_warp_scalar(probe_filter):
     return warp_scalar
 
 
+def probe_weights(source_delaunay, input_poly_data):
+    """locate every input point in the source triangulation once.
+       Return the ids of the three corners of the triangle around each point and
+       their barycentric weights, i.e. a sparse n_input x n_source interpolation matrix
+       with three entries per row. Points outside the source get zero weights,
+       the same as vtkProbeFilter gives them 0"""
+
+    triangles = source_delaunay.GetOutput()
+
+    # probe a cell id array once to learn which triangle every input point falls in
+    located = vtk.vtkPolyData()
+    located.ShallowCopy(triangles)
+    cell_ids = numpy_support.numpy_to_vtk(np.arange(located.GetNumberOfCells(), dtype=np.float64), deep=True)
+    cell_ids.SetName('CellId')
+    located.GetCellData().AddArray(cell_ids)
+
+    probe_filter = vtk.vtkProbeFilter()
+    probe_filter.SetSourceData(located)
+    probe_filter.SetInputData(input_poly_data)
+    probe_filter.Update()
+    probed = probe_filter.GetOutput().GetPointData()
+
+    valid = numpy_support.vtk_to_numpy(probed.GetArray(probe_filter.GetValidPointMaskArrayName())).astype(bool)
+    cells = numpy_support.vtk_to_numpy(probed.GetArray('CellId')).astype(np.int64)
+
+    corners = numpy_support.vtk_to_numpy(triangles.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    source_xy = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData())[:, :2].astype(np.float64)
+    input_xy = numpy_support.vtk_to_numpy(input_poly_data.GetPoints().GetData())[:, :2].astype(np.float64)
+
+    ids = corners[cells]
+    a, b, c = source_xy[ids[:, 0]], source_xy[ids[:, 1]], source_xy[ids[:, 2]]
+    v0, v1, v2 = b - a, c - a, input_xy - a
+    d00 = (v0 * v0).sum(axis=1)
+    d01 = (v0 * v1).sum(axis=1)
+    d11 = (v1 * v1).sum(axis=1)
+    d20 = (v2 * v0).sum(axis=1)
+    d21 = (v2 * v1).sum(axis=1)
+    denom = d00 * d11 - d01 * d01
+    denom[denom == 0] = 1.
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+
+    weights = np.column_stack((1. - v - w, v, w))
+    weights[~valid] = 0.
+
+    return ids, weights
+
+
+def points_key(*poly_datas):
+    """hash the point coordinates of some poly data"""
+
+    sha = hashlib.sha1()
+    for poly_data in poly_datas:
+        sha.update(numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData()).tobytes())
+
+    return sha.hexdigest()
+
+
+def source_key(source_delaunay):
+    """hash the points and the triangles of a probe source, the weights change with either"""
+
+    source = source_delaunay.GetOutput()
+    sha = hashlib.sha1(numpy_support.vtk_to_numpy(source.GetPoints().GetData()).tobytes())
+    sha.update(numpy_support.vtk_to_numpy(source.GetPolys().GetConnectivityArray()).astype(np.int64).tobytes())
+
+    return sha.hexdigest()
+
+
+def cached_probe_weights(source_delaunay, input_poly_data, cache_name=PROBE_WEIGHTS_NAME):
+    """probe_weights, saved to cache_name and reused while the source and input points stay the same"""
+
+    key = source_key(source_delaunay) + points_key(input_poly_data)
+    if os.path.exists(cache_name):
+        cached = np.load(cache_name)
+        if str(cached['key']) == key:
+            print("reused " + cache_name)
+            return cached['ids'], cached['weights']
+
+    ids, weights = probe_weights(source_delaunay, input_poly_data)
+    np.savez(cache_name, key=key, ids=ids, weights=weights)
+    print("wrote " + cache_name)
+
+    return ids, weights
+
+
+def warp_with_weights(poly_data, source_values, ids, weights):
+    """the probe + warp scalar of a poly data in one sparse mat-vec:
+       lift every point by the source values interpolated with the precomputed weights"""
+
+    xyz = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+    xyz[:, 2] += (weights * source_values[ids]).sum(axis=1)
+    poly_data.GetPoints().Modified()
+
+    valid = numpy_support.numpy_to_vtk(weights.any(axis=1).astype(np.int8), deep=True,
+                                       array_type=vtk.VTK_CHAR)
+    valid.SetName('vtkValidPointMask')
+    poly_data.GetPointData().AddArray(valid)
+
+    return poly_data
+
+
+def create_triangulation(poly_data):
+    """create 2D delunay of poly data that is already warped"""
+
+    delaunay = vtk.vtkDelaunay2D()
+    delaunay.SetInputData(poly_data)
+    delaunay.Update()
+
+    return delaunay
+
+
+def lattice_columns(x, y, chunk_points=None):
+    """number of points in a row of points laid out row by row: a row ends where the next step turns back
+       against the first one. The turn is looked for chunk_points at a time (all at once if None).
+       Return None if the points cannot be such a lattice"""
+
+    chunk_points = chunk_points or len(x)
+    first_step = None
+    for start in range(0, len(x) - 1, chunk_points):
+        stop = start + chunk_points + 1
+        step = np.diff(np.column_stack((x[start:stop], y[start:stop])).astype(np.float64), axis=0)
+        first_step = step[:1] if first_step is None else first_step
+        turned = np.flatnonzero((step * first_step).sum(axis=1) <= 0)
+        if len(turned):
+            columns = start + int(turned[0]) + 1
+            break
+    else:
+        return None
+    if columns == 1 or len(x) % columns or len(x) // columns < 2:
+        return None
+
+    return columns
+
+
+def lattice_cells(grid, first_id=0):
+    """split the quads between the rows of points of grid (rows x columns x 2) along their shorter diagonal.
+       Every quad must be convex and turn the same way as all the others.
+       Return the first and the second triangle of every quad as n x 3 arrays of point ids counted from first_id
+       and the way the quads turn (1 counterclockwise, -1 clockwise), or None if they are not such quads"""
+
+    a, b, c, d = grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]
+
+    def turn(p, q, r):
+        return (q - p)[..., 0] * (r - q)[..., 1] - (q - p)[..., 1] * (r - q)[..., 0]
+
+    turns = np.sign([turn(a, b, c), turn(b, c, d), turn(c, d, a), turn(d, a, b)])
+    if turns.flat[0] == 0 or not (turns == turns.flat[0]).all():
+        return None
+
+    ids = first_id + np.arange(grid.shape[0] * grid.shape[1]).reshape(grid.shape[:2])
+    ia, ib, ic, id_ = ids[:-1, :-1].ravel(), ids[:-1, 1:].ravel(), ids[1:, 1:].ravel(), ids[1:, :-1].ravel()
+    short_ac = (((a - c) ** 2).sum(axis=-1) <= ((b - d) ** 2).sum(axis=-1)).ravel()
+    first = np.where(short_ac[:, None], np.column_stack((ia, ib, ic)), np.column_stack((ia, ib, id_)))
+    second = np.where(short_ac[:, None], np.column_stack((ia, ic, id_)), np.column_stack((ib, ic, id_)))
+
+    return first, second, turns.flat[0]
+
+
+def lattice_triangles(xy):
+    """triangles of points laid out row by row on a regular, possibly rotated, lattice, as the simulation
+       grid of the amplitude files is (see lattice_columns). Every cell of the lattice must then be a convex quad
+       turning the same way as all the others, so a grid bent a little by a map projection is still taken.
+       Each quad is split along its shorter diagonal. Return an n x 3 array of point ids,
+       or None if the points are not such a lattice and need a delaunay"""
+
+    xy = np.asarray(xy, dtype=np.float64)
+    columns = lattice_columns(xy[:, 0], xy[:, 1])
+    cells = None if columns is None else lattice_cells(xy.reshape(-1, columns, 2))
+    if cells is None:
+        return None
+    first, second, turn = cells
+    triangles = np.concatenate((first, second))
+    if turn < 0:
+        triangles = triangles[:, ::-1]  # counterclockwise, as the delaunay gives them
+
+    return triangles
+
+
+def amplitude_triangulation(poly_data):
+    """triangles of the amplitude points as a vtkCellArray: straight from the lattice
+       when lattice_triangles finds one, from create_triangulation for scattered points"""
+
+    triangles = lattice_triangles(numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())[:, :2])
+    if triangles is None:
+        return create_triangulation(poly_data).GetOutput().GetPolys()
+    logger.debug("amplitude points are a lattice, skipped the delaunay")
+
+    return build_triangles(triangles)
+
+
+def share_triangulation(triangles, poly_data):
+    """give poly_data the triangles of an earlier triangulation of the same x/y points.
+       Only the points and point data of poly_data are used, the connectivity is shared.
+       Return a pipeline producer so it can be written like a delaunay"""
+
+    surface = vtk.vtkPolyData()
+    surface.SetPoints(poly_data.GetPoints())
+    surface.SetPolys(triangles)
+    surface.GetPointData().ShallowCopy(poly_data.GetPointData())
+
+    producer = vtk.vtkTrivialProducer()
+    producer.SetOutput(surface)
+
+    return producer
+
+
 def set_scalar_data(input_scalar, poly_data):
     """set the dalaunay as scalar data"""
 
@@ -454,26 +1340,35 @@ def set_scalar_data(input_scalar, poly_data):
 
 
 def warp_delaunay_writer(warp_delaunay, out_name):
-    """write the delaunay to a vtp file.
+    """write the delaunay to a vtp file, encoded as set in WRITER_OPTIONS.
        Note the difference with the poly writer.
        Here we require a pipline connection"""
 
+    if WRITER_OPTIONS['precision'] is not None:  # points can only be converted on the data itself
+        warp_delaunay.Update()
+        write_poly(warp_delaunay.GetOutputDataObject(0), out_name)
+        return
+
     warp_delaunay_writer = vtk.vtkXMLPolyDataWriter()
     warp_delaunay_writer.SetFileName(out_name)
     warp_delaunay_writer.SetInputConnection(warp_delaunay.GetOutputPort())
+    configure_writer(warp_delaunay_writer, WRITER_OPTIONS['encoding'], WRITER_OPTIONS['compressor'],
+                     WRITER_OPTIONS['level'])
     warp_delaunay_writer.Write()
+    count_points(warp_delaunay.GetOutputDataObject(0).GetNumberOfPoints())
 
 
-def create_elevation_surfaces(binaryNamePrefix, total, faults_sum):
-    """create 4 types of elevation surfaces:
+def create_terrain_surfaces(faults_sum, elevationDelaunay=None):
+    """create 3 types of elevation surfaces:
        1. an elevation surface of the terrain for applying texture;
        2. an elevation surface of terrain-warped boundary;
-       3. 12 elevation surfaces of terrain-warped faults
-       4. an elevation surface of terrain-warped amplitude."""
+       3. 12 elevation surfaces of terrain-warped faults.
+       elevationDelaunay is the terrain_surface of FLAT_TERRAIN_NAME, built here if not given.
+       Return the files written"""
 
     # elevates terrain
-    elevationPolyData = read_poly_data(FLAT_TERRAIN_NAME)
-    elevationDelaunay = create_delaunay(elevationPolyData)
+    if elevationDelaunay is None:
+        elevationDelaunay = terrain_surface(read_poly_data(FLAT_TERRAIN_NAME))
     elevation_scalar = create_warp_scalar(elevationDelaunay)
     warp_delaunay_writer(elevation_scalar, ElEVATED_TERRAIN_NAME)
 
@@ -493,58 +1388,910 @@ def create_elevation_surfaces(binaryNamePrefix, total, faults_sum):
         warp_delaunay_writer(fault_warp_terrain_dealuny, FAULT_WARP_FORMAT.format(j))
         print("wrote " + FAULT_WARP_FORMAT.format(j))
 
-    # warp terrain and amplitude
-    for i in range(total):
+    return [ElEVATED_TERRAIN_NAME, BOUNDARY_W_TERRAIN] + [FAULT_WARP_FORMAT.format(j) for j in range(faults_sum)]
+
+
+def create_terrain_levels(lod_factors):
+    """create an elevation surface of the terrain for every level of detail written by append_vtps
+       and index them, coarsest first, in the multiblock ELEVATED_TERRAIN_LOD_INDEX.
+       The level of COUNTER_FACTOR indexes the ElEVATED_TERRAIN_NAME of create_terrain_surfaces.
+       Return the names of the files written"""
+
+    levels = []
+    written = []
+    for factor in sorted(set(lod_factors), reverse=True):
+        flatName, elevatedName = terrain_level_names(factor)
+        if factor != COUNTER_FACTOR:
+            elevationDelaunay = terrain_surface(read_poly_data(flatName))
+            warp_delaunay_writer(create_warp_scalar(elevationDelaunay), elevatedName)
+            print("wrote " + elevatedName)
+            written.append(elevatedName)
+        levels.append(('factor {}'.format(factor), elevatedName))
+    write_multiblock_index(ELEVATED_TERRAIN_LOD_INDEX, levels)
+
+    return written + [ELEVATED_TERRAIN_LOD_INDEX]
+
+
+def write_multiblock_index(index_name, blocks):
+    """write a vtm file for Paraview gathering the (name, vtp file) blocks into one multiblock data set.
+       Only the index is written, the blocks stay in their own files"""
+
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="vtkMultiBlockDataSet" version="1.0" byte_order="LittleEndian">',
+             '  <vtkMultiBlockDataSet>']
+    for index, (name, vtpName) in enumerate(blocks):
+        lines.append('    <DataSet index="{}" name="{}" file="{}"/>'.format(index, name, vtpName))
+    lines += ['  </vtkMultiBlockDataSet>', '</VTKFile>']
+
+    with open(index_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_collection_index(index_name, datasets):
+    """write a pvd file for Paraview playing the (time, vtp file) datasets as one time series.
+       Only the index is written, the datasets stay in their own files"""
+
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="Collection" version="0.1" byte_order="LittleEndian">',
+             '  <Collection>']
+    for time_value, vtpName in datasets:
+        lines.append('    <DataSet timestep="{!r}" part="0" file="{}"/>'.format(time_value, vtpName))
+    lines += ['  </Collection>', '</VTKFile>']
+
+    with open(index_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def warp_amplitude_surfaces(elevationDelaunay, amplitude_poly_datas):
+    """take the terrain delaunay and an iterable of amplitude poly data,
+       yield every one of them warped by the terrain and triangulated, as a pipeline producer.
+       The amplitude points are the same in every timestep, so they are located in the terrain
+       and triangulated once. Later timesteps only swap in their own z and scalars"""
+
+    elevation = numpy_support.vtk_to_numpy(elevationDelaunay.GetOutput().GetPointData().GetScalars())
+    amp_xy = ids = weights = amp_triangles = None
+    for amplitudePolyData in amplitude_poly_datas:
+        xy = numpy_support.vtk_to_numpy(amplitudePolyData.GetPoints().GetData())[:, :2]
+        if amp_xy is None or not np.array_equal(xy, amp_xy):
+            ids, weights = cached_probe_weights(elevationDelaunay, amplitudePolyData)
+            amp_xy = xy.copy()
+            amp_triangles = None
+        warp_with_weights(amplitudePolyData, elevation, ids, weights)
+        if amp_triangles is None:
+            amp_triangles = amplitude_triangulation(amplitudePolyData)
+        yield share_triangulation(amp_triangles, amplitudePolyData)
+
+
+def read_converted_frames(binaryNamePrefix, frames):
+    """yield the amplitude poly data converted in step 1 for the timesteps listed in frames, one at a time"""
+
+    for i in frames:
         filename = CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)
         print("Processing {} now".format(filename))
-        amplitudePolyData = read_poly_data(filename)
-        amp_probe_filter = create_probe_filter(elevationDelaunay, amplitudePolyData)
-        amp_warp_scalar = create_warp_scalar(amp_probe_filter)
-        amplitudeWarpDelaunay = set_scalar_data(amp_warp_scalar, amplitudePolyData)
-        out_name = AMP_WARP_FORMAT.format(i)
-        warp_delaunay_writer(amplitudeWarpDelaunay, out_name)
+        yield read_poly_data(filename)
+
+
+def warp_amplitude_frames(elevationDelaunay, binaryNamePrefix, frames, done=None, chunk_points=None):
+    """warp the converted amplitude timesteps listed in frames by the terrain and write them.
+       done(i) is called once timestep i is written.
+       chunk_points warps every timestep that many points at a time (see write_amplitude_chunked)"""
+
+    frames = list(frames)
+    if chunk_points is not None:
+        state = {}
+        for i in frames:
+            filename = CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)
+            print("Processing {} now".format(filename))
+            write_amplitude_chunked(elevationDelaunay, vtp_columns(filename), AMP_WARP_FORMAT.format(i),
+                                    chunk_points, state)
+            if done is not None:
+                done(i)
+        return
+    surfaces = warp_amplitude_surfaces(elevationDelaunay, read_converted_frames(binaryNamePrefix, frames))
+    for i, amplitudeWarpDelaunay in zip(frames, surfaces):
+        warp_delaunay_writer(amplitudeWarpDelaunay, AMP_WARP_FORMAT.format(i))
+        if done is not None:
+            done(i)
 
 
 # ===================================================================================================================
 # STEP 6: push surfaces in z-direction
 
-def push_warp_surface_up(push_value, total, in_format, scalar_shown=False):
-    """push the warp_surface z-ed wise up by some value so that we can see it in a more-3D pespective"""
+def push_points(poly_data, push_value, scalar_shown=False):
+    """push the points of poly_data z-ed wise up by push_value,
+       plus scalar / SCALAR_DIVISION_FACTOR if scalar_shown, in one numpy operation"""
+
+    xyz = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+    scalars = numpy_support.vtk_to_numpy(poly_data.GetPointData().GetScalars()) if scalar_shown else None
+    xyz[:, 2] = pushed_z(xyz[:, 2], push_value, scalars)
+    poly_data.GetPoints().Modified()
+
+    return poly_data
+
+
+def pushed_z(z, push_value, scalars=None):
+    """z pushed up by push_value, plus scalars / SCALAR_DIVISION_FACTOR if scalars are given, computed in float64"""
+
+    z = z.astype(np.float64) + push_value
+    if scalars is not None:
+        z += scalars.astype(np.float64) / SCALAR_DIVISION_FACTOR
+
+    return z
+
+
+def pushed_surfaces(push_value, frames, in_format, scalar_shown=False):
+    """read the warp_surfaces listed in frames one at a time, yield them pushed z-ed wise up by some value"""
 
-    for j in range(total):
+    for j in frames:
         poly_data = read_poly_data(in_format.format(j))
-        points = poly_data.GetPoints()
-        print("read " + in_format.format(j))
-
-        for i in range(points.GetNumberOfPoints()):
-            x, y, z = points.GetPoint(i)
-            z += push_value
-            if scalar_shown:
-                scalar_value = poly_data.GetPointData().GetScalars().GetValue(i)
-                z += scalar_value / SCALAR_DIVISION_FACTOR
-            points.SetPoint(i, x, y, z)
+        logger.debug("read " + in_format.format(j))
+
+        yield push_points(poly_data, push_value, scalar_shown)
+
+
+def push_warp_surface_up(push_value, total, in_format, scalar_shown=False, frames=None, chunk_points=None,
+                         done=None):
+    """push the warp_surface z-ed wise up by some value so that we can see it in a more-3D pespective.
+       frames lists the surfaces to push, all total of them by default,
+       done(j) is called once surface j is pushed.
+       With chunk_points, surfaces written by a chunked run are pushed that many points at a time.
+       Return the files written"""
+
+    frames = list(range(total) if frames is None else frames)
+    unchunked = []
+    for j in frames:
+        if chunk_points is not None:
+            if push_vtp_chunked(in_format.format(j), ('pushed_' + in_format).format(j), push_value, scalar_shown,
+                                chunk_points):
+                if done is not None:
+                    done(j)
+                continue
+            logger.warning("%s was not written chunk by chunk, pushed whole despite the memory budget",
+                           in_format.format(j))
+        unchunked.append(j)
+    for j, poly_data in zip(unchunked, pushed_surfaces(push_value, unchunked, in_format, scalar_shown)):
         pushed_vtp_file = ('pushed_' + in_format).format(j)
         write_poly(poly_data, pushed_vtp_file)
         print("wrote " + in_format.format(j))
+        if done is not None:
+            done(j)
     print("end pushing")
 
+    return [('pushed_' + in_format).format(j) for j in frames]
+
+
+def interpolation_weights(steps, cubic=False):
+    """weights of the timesteps around a gap for the steps frames put into it, one row per frame:
+       linear on the two timesteps of the gap, or Catmull-Rom cubic on the four around it"""
+
+    t = np.arange(1, steps + 1) / (steps + 1.)
+    if not cubic:
+        return np.column_stack((1. - t, t))
+
+    return np.column_stack(((-t ** 3 + 2 * t ** 2 - t) / 2., (3 * t ** 3 - 5 * t ** 2 + 2) / 2.,
+                            (-3 * t ** 3 + 4 * t ** 2 + t) / 2., (t ** 3 - t ** 2) / 2.))
+
+
+def with_frame(template, z, scalars):
+    """a surface sharing the cells and other point data of template, with its own z and scalars"""
+
+    xyz = numpy_support.vtk_to_numpy(template.GetPoints().GetData()).copy()
+    xyz[:, 2] = z
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(xyz, deep=False))
+
+    surface = vtk.vtkPolyData()
+    surface.SetPoints(points)
+    surface.SetVerts(template.GetVerts())
+    surface.SetPolys(template.GetPolys())
+    surface.GetPointData().ShallowCopy(template.GetPointData())
+    values = numpy_support.numpy_to_vtk(np.asarray(scalars, dtype=np.float32), deep=True)
+    values.SetName(template.GetPointData().GetScalars().GetName())
+    surface.GetPointData().SetScalars(values)
+
+    return surface
+
+
+def interpolate_frames(total, steps, in_format, out_format=AMP_INTERP_FORMAT, cubic=False):
+    """put steps frames between every two consecutive surfaces in_format.format(i), interpolating
+       their z and scalars (see interpolation_weights), and write them to out_format.format(i, step).
+       The surfaces are read one at a time and only the two (four if cubic) around a gap are kept,
+       every frame of a gap comes from one matrix product on them.
+       Return (time, vtp file) of every surface, read and written, in time order"""
+
+    weights = interpolation_weights(steps, cubic)
+    window = {}
+    timeline = []
+    for i in range(total):
+        timeline.append((float(i), in_format.format(i)))
+        if i == total - 1:
+            break
+        around = [min(max(j, 0), total - 1) for j in (range(i - 1, i + 3) if cubic else range(i, i + 2))]
+        for j in list(window):
+            if j not in around:
+                del window[j]
+        for j in around:
+            if j not in window:
+                window[j] = read_poly_data(in_format.format(j))
+        columns = [(numpy_support.vtk_to_numpy(window[j].GetPoints().GetData()),
+                    numpy_support.vtk_to_numpy(window[j].GetPointData().GetScalars())) for j in around]
+        xy = columns[0][0][:, :2]
+        for j, (xyz, _) in zip(around, columns):
+            if not np.array_equal(xyz[:, :2], xy):
+                raise ValueError("{} and {} do not share their points".format(in_format.format(around[0]),
+                                                                              in_format.format(j)))
+        zs = weights.dot(np.stack([xyz[:, 2] for xyz, _ in columns]).astype(np.float64))
+        scalars = weights.dot(np.stack([values for _, values in columns]).astype(np.float64))
+        for step in range(steps):
+            out_name = out_format.format(i, step + 1)
+            write_poly(with_frame(window[i], zs[step], scalars[step]), out_name)
+            print("wrote " + out_name)
+            timeline.append((i + (step + 1) / (steps + 1.), out_name))
+
+    return timeline
+
+
+def write_timeline(total, steps, cubic=False, in_format='pushed_' + AMP_WARP_FORMAT):
+    """interpolate_frames between the total pushed amplitude timesteps and play them all from AMP_TIMELINE_NAME.
+       Return the files written"""
+
+    timeline = interpolate_frames(total, steps, in_format, AMP_INTERP_FORMAT, cubic)
+    write_collection_index(AMP_TIMELINE_NAME, timeline)
+
+    pushed = [in_format.format(i) for i in range(total)]
+
+    return [name for _, name in timeline if name not in pushed] + [AMP_TIMELINE_NAME]
+
+
+def push_amplitude_series(push_value, total, scalar_shown=False):
+    """push the total warped amplitude timesteps up like push_warp_surface_up,
+       into one AMP_SERIES_NAME file instead of one vtp each. Return the files written"""
+
+    write_vtkhdf_series(AMP_SERIES_NAME, counted(pushed_surfaces(push_value, range(total), AMP_WARP_FORMAT,
+                                                                 scalar_shown)))
+    print("wrote " + AMP_SERIES_NAME)
 
-def push_surfaces(faults_push_value, amp_total, faults_sum, scalar_shown):
-    """push 3 types of surfaces up"""
+    return [AMP_SERIES_NAME]
 
-    # push boundary_warp_terrain
-    push_warp_surface_up(faults_push_value + 0.015, 1, BOUNDARY_W_TERRAIN)
 
-    # pushe amplitude_warp_surface
-    push_warp_surface_up(faults_push_value + 0.01, amp_total, AMP_WARP_FORMAT, scalar_shown)
+# ===================================================================================================================
+# STEPS 1, 5 and 6 in memory: stream the amplitude timesteps without intermediate files
+
+def stream_amplitude_surfaces(binaryNamePrefix, endianess, extension, total, elevationDelaunay,
+                              faults_push_value, scalar_shown, keep_intermediates=False, series=False,
+                              frames=None, done=None, chunk_points=None, region=None):
+    """take every binary file through conversion, terrain warping and pushing in memory,
+       one timestep at a time, and write only the pushed amplitude surface.
+       Only the points inside region are taken if there is one.
+       keep_intermediates also writes the converted and warped surfaces for debugging.
+       series writes all pushed timesteps into one AMP_SERIES_NAME file instead of one vtp each.
+       frames lists the timesteps to take, all total of them by default,
+       done(i) is called once the pushed surface of timestep i is written.
+       chunk_points takes every timestep that many points at a time (see write_amplitude_chunked),
+       only one vtp per timestep can be written that way.
+       Return the files written"""
+
+    frames = list(range(total) if frames is None else frames)
+    binaryNames = [(BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, i) for i in range(total)]
+    sketches = {}
+    written = []
+    if chunk_points is not None:
+        assert not series, "a series is written in memory"
+        state = {}
+        for i in frames:
+            binaryName = binaryNames[i]
+            print("Processing {} now".format(binaryName))
+            if keep_intermediates:
+                converted_name = CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)
+            else:
+                converted_name = REGION_POINTS_FORMAT.format(i)
+            if keep_intermediates or region is not None:
+                # the points inside a region are gathered chunk by chunk in the converted file and mapped from it
+                sketches[binaryName] = convert_binary_chunked(binaryName, endianess, converted_name, chunk_points,
+                                                              region)
+                columns = vtp_columns(converted_name)
+            else:
+                x, y, z = extract_xyz(binaryName, endianess)
+                columns = (x, y, None, z)
+                sketches[binaryName] = scalar_sketch(z, chunk_points)
+            if keep_intermediates:
+                write_amplitude_chunked(elevationDelaunay, columns, AMP_WARP_FORMAT.format(i), chunk_points, state)
+                written += [converted_name, AMP_WARP_FORMAT.format(i)]
+            pushed_vtp_file = ('pushed_' + AMP_WARP_FORMAT).format(i)
+            write_amplitude_chunked(elevationDelaunay, columns, pushed_vtp_file, chunk_points, state,
+                                    faults_push_value + AMP_PUSH_OFFSET, scalar_shown)
+            print("wrote " + pushed_vtp_file)
+            written.append(pushed_vtp_file)
+            if not keep_intermediates and region is not None:
+                os.remove(converted_name)  # state keeps the mapping until the next timestep, not the file
+            if done is not None:
+                done(i)
+        update_scalar_stats(binaryNames, endianess, sketches, region)
+        return written
+
+    def read_frames():
+        for i in frames:
+            binaryName = binaryNames[i]
+            print("Processing {} now".format(binaryName))
+            polyData = read_points(binaryName, endianess, region)
+            sketches[binaryName] = scalar_sketch(numpy_support.vtk_to_numpy(polyData.GetPointData().GetScalars()))
+            if keep_intermediates:
+                write_poly(polyData, CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i))
+                written.append(CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i))
+            yield polyData
+
+    def pushed():
+        for i, amplitudeWarpDelaunay in zip(frames, warp_amplitude_surfaces(elevationDelaunay, read_frames())):
+            if keep_intermediates:
+                warp_delaunay_writer(amplitudeWarpDelaunay, AMP_WARP_FORMAT.format(i))
+                written.append(AMP_WARP_FORMAT.format(i))
+            surface = amplitudeWarpDelaunay.GetOutputDataObject(0)
+            yield push_points(surface, faults_push_value + AMP_PUSH_OFFSET, scalar_shown)
+
+    if series:
+        write_vtkhdf_series(AMP_SERIES_NAME, counted(pushed()))
+        print("wrote " + AMP_SERIES_NAME)
+        written.append(AMP_SERIES_NAME)
+    else:
+        for i, surface in zip(frames, pushed()):
+            pushed_vtp_file = ('pushed_' + AMP_WARP_FORMAT).format(i)
+            write_poly(surface, pushed_vtp_file)
+            print("wrote " + pushed_vtp_file)
+            written.append(pushed_vtp_file)
+            if done is not None:
+                done(i)
+    update_scalar_stats(binaryNames, endianess, sketches, region)
+
+    return written
+
+
+# ===================================================================================================================
+# SCALAR STATISTICS: range, quantiles and histogram of the amplitude over all timesteps, gathered while
+# the timesteps are read anyway. Quantiles come from a mergeable sketch with log-spaced buckets
+# (relative error STATS_ACCURACY), kept per timestep in SCALAR_STATS_NAME so reruns only add the new ones
+
+def sketch_gamma():
+    """ratio between the bounds of a bucket of the quantile sketch"""
+
+    return (1. + STATS_ACCURACY) / (1. - STATS_ACCURACY)
+
+
+def scalar_sketch(values, chunk_points=CHUNK_POINTS):
+    """count, min, max, sum and log-bucket counts of values, taken chunk_points at a time.
+       Bucket i of the positive (negative) values holds those in (gamma^(i-1), gamma^i]"""
+
+    sketch = {'count': 0, 'min': None, 'max': None, 'sum': 0., 'zero': 0, 'positive': {}, 'negative': {}}
+    log_gamma = np.log(sketch_gamma())
+    for start in range(0, len(values), chunk_points):
+        chunk = np.asarray(values[start:start + chunk_points], dtype=np.float64)
+        chunk = chunk[np.isfinite(chunk)]
+        if not len(chunk):
+            continue
+        part = {'count': len(chunk), 'min': float(chunk.min()), 'max': float(chunk.max()),
+                'sum': float(chunk.sum()), 'zero': int(np.count_nonzero(np.abs(chunk) <= STATS_MIN_VALUE))}
+        for side, side_values in (('positive', chunk[chunk > STATS_MIN_VALUE]),
+                                  ('negative', -chunk[chunk < -STATS_MIN_VALUE])):
+            buckets, counts = np.unique(np.ceil(np.log(side_values) / log_gamma).astype(np.int64), return_counts=True)
+            part[side] = {str(bucket): int(count) for bucket, count in zip(buckets, counts)}
+        sketch = merge_sketches([sketch, part])
+
+    return sketch
+
+
+def merge_sketches(sketches):
+    """one scalar_sketch of all values counted in sketches"""
+
+    merged = {'count': 0, 'min': None, 'max': None, 'sum': 0., 'zero': 0, 'positive': {}, 'negative': {}}
+    for sketch in sketches:
+        if not sketch['count']:
+            continue
+        merged['min'] = sketch['min'] if merged['min'] is None else min(merged['min'], sketch['min'])
+        merged['max'] = sketch['max'] if merged['max'] is None else max(merged['max'], sketch['max'])
+        for field in ('count', 'sum', 'zero'):
+            merged[field] += sketch[field]
+        for side in ('positive', 'negative'):
+            for bucket, count in sketch[side].items():
+                merged[side][bucket] = merged[side].get(bucket, 0) + count
+
+    return merged
+
+
+def sketch_values(sketch):
+    """the value standing for every bucket of a sketch and its count, sorted by value"""
+
+    gamma = sketch_gamma()
+    values = [2. * gamma ** int(bucket) / (gamma + 1.) for bucket in sketch['positive']]
+    values += [-2. * gamma ** int(bucket) / (gamma + 1.) for bucket in sketch['negative']]
+    values = np.array(values + [0.])
+    counts = np.array(list(sketch['positive'].values()) + list(sketch['negative'].values()) + [sketch['zero']])
+    order = np.argsort(values)
+
+    return np.clip(values[order], sketch['min'], sketch['max']), counts[order]
+
+
+def sketch_quantile(sketch, q):
+    """approximate q quantile of the values counted in a sketch"""
+
+    values, counts = sketch_values(sketch)
+    rank = q * (sketch['count'] - 1)
+
+    return float(values[np.searchsorted(np.cumsum(counts), rank, side='right')])
+
+
+def summarize_sketch(sketch):
+    """count, min, max, mean, STATS_QUANTILES and a STATS_BINS histogram of a sketch"""
+
+    if not sketch['count']:
+        return {'count': 0}
+    values, counts = sketch_values(sketch)
+    histogram, edges = np.histogram(values, STATS_BINS, (sketch['min'], sketch['max']), weights=counts)
+
+    return {'count': sketch['count'], 'min': sketch['min'], 'max': sketch['max'],
+            'mean': sketch['sum'] / sketch['count'],
+            'quantiles': {str(q): sketch_quantile(sketch, q) for q in STATS_QUANTILES},
+            'histogram': {'edges': edges.tolist(), 'counts': histogram.astype(np.int64).tolist()}}
+
+
+def load_scalar_stats(stats_name=SCALAR_STATS_NAME):
+    """read SCALAR_STATS_NAME, None if there is none"""
+
+    if not os.path.exists(stats_name):
+        return None
+    with open(stats_name) as f:
+        return json.load(f)
+
+
+def update_scalar_stats(binaryNames, endianess, sketches=None, region=None, stats_name=SCALAR_STATS_NAME):
+    """write the amplitude statistics of the binary files binaryNames, inside region if there is one,
+       to stats_name and return them.
+       A timestep takes its sketch from sketches (binary name: scalar_sketch) when it was just read,
+       from the last stats_name while its binary is unchanged,
+       and only otherwise reads the z column of its binary once more"""
+
+    old = load_scalar_stats(stats_name)
+    unchanged = old is not None and old.get('accuracy') == STATS_ACCURACY and old.get('region') == region
+    old_frames = old['frames'] if unchanged else {}
+    sketches = sketches or {}
+    frames = {}
+    for binaryName in binaryNames:
+        signature = file_signature(binaryName)
+        if binaryName in sketches:
+            sketch = sketches[binaryName]
+        elif binaryName in old_frames and old_frames[binaryName]['signature'] == signature:
+            sketch = old_frames[binaryName]['sketch']
+        else:
+            sketch = merge_sketches(scalar_sketch(z) for _, _, z in iter_xyz_chunks(binaryName, endianess,
+                                                                                     region=region))
+        frames[binaryName] = {'signature': signature, 'sketch': sketch}
+
+    stats = dict(summarize_sketch(merge_sketches(frame['sketch'] for frame in frames.values())),
+                 accuracy=STATS_ACCURACY, region=region, frames=frames)
+    if stats != old:
+        with open(stats_name + '.part', 'w') as f:
+            json.dump(stats, f, indent=1)
+        os.replace(stats_name + '.part', stats_name)
+        print("wrote " + stats_name)
+
+    return stats
+
+
+def auto_scalar_division(stats):
+    """SCALAR_DIVISION_FACTOR lifting the amplitude at its AUTO_SCALAR_QUANTILE by SCALAR_LIFT"""
+
+    if not stats['count']:
+        return SCALAR_DIVISION_FACTOR
+    sketch = merge_sketches(frame['sketch'] for frame in stats['frames'].values())
+    quantile = max(abs(sketch_quantile(sketch, q)) for q in (1. - AUTO_SCALAR_QUANTILE, AUTO_SCALAR_QUANTILE))
+
+    return quantile / SCALAR_LIFT if quantile > 0 else SCALAR_DIVISION_FACTOR
+
+
+# ===================================================================================================================
+# OUT-OF-CORE: take an amplitude timestep through steps 1, 5 and 6 in chunks of points.
+# Only a chunk of a timestep is in memory at a time, files are written in place chunk by chunk
+# (raw uncompressed vtp, see write_vtp_chunks) and read back memory-mapped (map_vtp).
+# Lattice triangles are written block of rows by block of rows too, only scattered points
+# need a delaunay of the whole timestep.
+
+def budget_chunk_points(memory_budget):
+    """number of amplitude points to take at a time to stay around memory_budget bytes"""
+
+    return max(1 << 10, int(memory_budget // CHUNK_BYTES_PER_POINT))
+
+
+def stack_xyz(x, y, z=None):
+    """pack x, y, z columns (z = 0 if None) into an n x 3 float32 array"""
+
+    xyz = np.zeros((len(x), 3), dtype=np.float32)
+    xyz[:, 0] = x
+    xyz[:, 1] = y
+    if z is not None:
+        xyz[:, 2] = z
+
+    return xyz
+
 
-    # push fault_warp_terrain
-    push_warp_surface_up(faults_push_value, faults_sum, FAULT_WARP_FORMAT)
+def convert_binary_chunked(binaryName, endianess, vtpName, chunk_points, region=None):
+    """convert a binary file to a vtp file chunk_points at a time,
+       the same points, vertices and scalars as read_points gives for region.
+       Return the scalar_sketch of the amplitude"""
+
+    sketches = []
+
+    def chunks():
+        start = 0
+        for x, y, z in iter_xyz_chunks(binaryName, endianess, chunk_points, region):
+            sketches.append(scalar_sketch(z))
+            yield start, stack_xyz(x, y), [z]
+            start += len(x)
+
+    if region is None:
+        number_of_points = len(map_records(binaryName, endianess))
+    else:  # one more pass over x, y to size the file
+        number_of_points = sum(len(x) for x, _, _ in iter_xyz_chunks(binaryName, endianess, chunk_points, region))
+    write_vtp_chunks(vtpName, number_of_points, chunks(), AMP_POINT_ARRAYS[:1], verts=True)
+    count_points(number_of_points)
+
+    return merge_sketches(sketches)
+
+
+def vtp_columns(vtpName):
+    """return x, y, z and scalars of the points of a vtp file,
+       memory-mapped if it was written chunk by chunk, read whole with a warning otherwise"""
+
+    mapped = map_vtp(vtpName)
+    if mapped is not None:
+        points, scalars = mapped['points'], mapped['point_data'][mapped['scalars']]
+    else:
+        logger.warning("%s was not written chunk by chunk, read whole despite the memory budget", vtpName)
+        poly_data = read_poly_data(vtpName)
+        points = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+        scalars = numpy_support.vtk_to_numpy(poly_data.GetPointData().GetScalars())
+
+    return points[:, 0], points[:, 1], points[:, 2], scalars
+
+
+def same_columns(columns, other_columns, chunk_points):
+    """check chunk by chunk if two sets of columns hold the same values"""
+
+    if len(columns[0]) != len(other_columns[0]):
+        return False
+
+    return all(np.array_equal(column[start:start + chunk_points], other[start:start + chunk_points])
+               for column, other in zip(columns, other_columns) for start in range(0, len(column), chunk_points))
+
+
+def chunked_probe_weights(source_delaunay, x, y, chunk_points, cache_name=PROBE_WEIGHTS_CHUNKED_NAME):
+    """probe_weights of the points x, y located chunk_points at a time.
+       They are kept on disk in cache_name and memory-mapped, reused while the source and the points stay the same"""
+
+    sha = hashlib.sha1(source_key(source_delaunay).encode())
+    for start in range(0, len(x), chunk_points):
+        sha.update(np.ascontiguousarray(x[start:start + chunk_points], dtype=np.float32).tobytes())
+        sha.update(np.ascontiguousarray(y[start:start + chunk_points], dtype=np.float32).tobytes())
+    key = sha.hexdigest()
+
+    key_name = cache_name + '.key'
+    if os.path.exists(cache_name) and os.path.exists(key_name):
+        with open(key_name) as f:
+            if f.read() == key:
+                cached = np.load(cache_name, mmap_mode='r')
+                print("reused " + cache_name)
+                return cached['ids'], cached['weights']
+
+    cached = np.lib.format.open_memmap(cache_name, mode='w+', shape=(len(x),),
+                                       dtype=[('ids', np.int64, 3), ('weights', np.float64, 3)])
+    for start in range(0, len(x), chunk_points):
+        zeros = np.zeros(len(x[start:start + chunk_points]), dtype=np.float32)
+        chunk = build_poly(x[start:start + chunk_points], y[start:start + chunk_points], zeros, zeros)
+        cached['ids'][start:start + chunk_points], cached['weights'][start:start + chunk_points] = \
+            probe_weights(source_delaunay, chunk)
+    cached.flush()
+    with open(key_name, 'w') as f:
+        f.write(key)
+    print("wrote " + cache_name)
+
+    return cached['ids'], cached['weights']
+
+
+def warped_chunks(columns, elevation, ids, weights, chunk_points, push_value=None, scalar_shown=False):
+    """yield (start, xyz, [scalars, valid mask]) of an amplitude timestep given as x, y, z, scalars columns,
+       warped by the terrain as warp_with_weights does and pushed as push_points does when push_value is given,
+       chunk_points at a time"""
+
+    x, y, z, scalars = columns
+    for start in range(0, len(x), chunk_points):
+        stop = min(start + chunk_points, len(x))
+        chunk_weights = np.asarray(weights[start:stop])
+        lift = (chunk_weights * elevation[ids[start:stop]]).sum(axis=1)
+        xyz = stack_xyz(x[start:stop], y[start:stop], lift if z is None else z[start:stop] + lift)
+        values = np.asarray(scalars[start:stop], dtype=np.float32)
+        if push_value is not None:
+            xyz[:, 2] = pushed_z(xyz[:, 2], push_value, values if scalar_shown else None)
+
+        yield start, xyz, [values, chunk_weights.any(axis=1).astype(np.int8)]
+
+
+def chunked_lattice_triangles(x, y, chunk_points, cache_name=AMP_TRIANGLES_NAME):
+    """lattice_triangles of the points x, y, taken a block of rows of about chunk_points points at a time
+       and written to cache_name. Return them memory-mapped, or None if the points are not a lattice"""
+
+    columns = lattice_columns(x, y, chunk_points)
+    if columns is None:
+        return None
+    rows = len(x) // columns
+    cells = (rows - 1) * (columns - 1)
+    triangles = np.lib.format.open_memmap(cache_name, mode='w+', dtype=np.int64, shape=(2 * cells, 3))
+    block_rows = max(1, chunk_points // columns)
+    turn = None
+    for row in range(0, rows - 1, block_rows):
+        stop = min(row + block_rows, rows - 1) + 1  # the last row of a block is the first of the next
+        xy = np.column_stack((x[row * columns:stop * columns], y[row * columns:stop * columns])).astype(np.float64)
+        block = lattice_cells(xy.reshape(-1, columns, 2), row * columns)
+        if block is None or turn not in (None, block[2]):
+            return None
+        first, second, turn = block
+        if turn < 0:
+            first, second = first[:, ::-1], second[:, ::-1]  # counterclockwise, as the delaunay gives them
+        start = row * (columns - 1)  # all first triangles, then all second ones, as lattice_triangles gives them
+        triangles[start:start + len(first)] = first
+        triangles[cells + start:cells + start + len(second)] = second
+    triangles.flush()
+    del triangles
+
+    return np.load(cache_name, mmap_mode='r')
+
+
+def chunked_triangulation(columns, elevation, ids, weights, chunk_points, cache_name=AMP_TRIANGLES_NAME):
+    """triangulate the warped amplitude points like amplitude_triangulation,
+       return the triangles as an n x 3 array memory-mapped from cache_name.
+       Only a lattice is triangulated chunk by chunk, scattered points are warped and triangulated all at once"""
+
+    triangles = chunked_lattice_triangles(columns[0], columns[1], chunk_points, cache_name)
+    if triangles is not None:
+        return triangles
+
+    logger.warning("the %d amplitude points are not a lattice, their delaunay is built for the whole timestep "
+                   "at once and may not stay within the memory budget", len(columns[0]))
+    xyz = np.concatenate([xyz for _, xyz, _ in warped_chunks(columns, elevation, ids, weights, chunk_points)])
+    zeros = np.zeros(len(xyz), dtype=np.float32)
+    triangulation = create_triangulation(build_poly(xyz[:, 0], xyz[:, 1], xyz[:, 2], zeros))
+    del xyz, zeros
+    np.save(cache_name, numpy_support.vtk_to_numpy(triangulation.GetOutput().GetPolys().GetConnectivityArray())
+            .reshape(-1, 3))
+
+    return np.load(cache_name, mmap_mode='r')
+
+
+def write_amplitude_chunked(elevationDelaunay, columns, out_name, chunk_points, state, push_value=None,
+                            scalar_shown=False):
+    """warp an amplitude timestep given as x, y, z, scalars columns (z = 0 if None) by the terrain,
+       push it when push_value is given, and write it to out_name chunk_points at a time.
+       state carries the probe weights and the triangulation from one timestep to the next,
+       they are only recomputed when the points move"""
+
+    elevation = numpy_support.vtk_to_numpy(elevationDelaunay.GetOutput().GetPointData().GetScalars())
+    if 'xy' not in state or not same_columns(columns[:2], state['xy'], chunk_points):
+        ids, weights = chunked_probe_weights(elevationDelaunay, columns[0], columns[1], chunk_points)
+        state.update(xy=columns[:2], ids=ids, weights=weights,
+                     triangles=chunked_triangulation(columns, elevation, ids, weights, chunk_points))
+
+    write_vtp_chunks(out_name, len(columns[0]),
+                     warped_chunks(columns, elevation, state['ids'], state['weights'], chunk_points, push_value,
+                                   scalar_shown),
+                     AMP_POINT_ARRAYS, polys=state['triangles'])
+    count_points(len(columns[0]))
+
+
+def push_vtp_chunked(vtpName, out_name, push_value, scalar_shown, chunk_points):
+    """push_points on a vtp file written chunk by chunk, chunk_points at a time.
+       Return False, writing nothing, if the file was not written that way"""
+
+    mapped = map_vtp(vtpName)
+    if mapped is None or len(mapped['lines'][0]) or len(mapped['strips'][0]):
+        return False
+    connectivity, offsets = mapped['polys']
+    if len(connectivity) != 3 * len(offsets) or len(mapped['verts'][1]) not in (0, len(mapped['points'])):
+        return False
+
+    points, arrays = mapped['points'], list(mapped['point_data'].values())
+    scalars = mapped['point_data'][mapped['scalars']]
+
+    def chunks():
+        for start in range(0, len(points), chunk_points):
+            xyz = np.array(points[start:start + chunk_points])
+            xyz[:, 2] = pushed_z(xyz[:, 2], push_value, scalars[start:start + chunk_points] if scalar_shown else None)
+            yield start, xyz, [array[start:start + chunk_points] for array in arrays]
+
+    point_arrays = [(name, array.dtype, 1 if array.ndim == 1 else array.shape[1])
+                    for name, array in mapped['point_data'].items()]
+    write_vtp_chunks(out_name, len(points), chunks(), point_arrays, verts=len(mapped['verts'][1]) > 0,
+                     polys=connectivity.reshape(-1, 3))
+    count_points(len(points))
+    print("wrote " + out_name)
+
+    return True
+
+
+# ===================================================================================================================
+# BUILD MANIFEST: rerun only the steps and timesteps whose inputs, parameters or outputs changed
+
+def load_manifest(manifest_name=MANIFEST_NAME):
+    """read the manifest of the last run, an empty one if there is none"""
+
+    if not os.path.exists(manifest_name):
+        return {'digests': {}, 'steps': {}}
+
+    with open(manifest_name) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_name=MANIFEST_NAME):
+    """write the manifest under a temporary name first so an interrupted run never leaves half of it behind"""
+
+    part_name = manifest_name + '.part'
+    with open(part_name, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(part_name, manifest_name)
+
+
+def file_signature(name):
+    """size and modification time of a file, cheap to check"""
+
+    stat = os.stat(name)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_digest(manifest, name):
+    """sha1 of the content of a file. The digest is kept in the manifest
+       and only recomputed when the size or modification time of the file changed"""
+
+    signature = file_signature(name)
+    known = manifest['digests'].get(name)
+    if known is not None and known['signature'] == signature:
+        return known['sha1']
+
+    sha1 = hashlib.sha1()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    manifest['digests'][name] = {'signature': signature, 'sha1': sha1.hexdigest()}
+
+    return sha1.hexdigest()
+
+
+def step_key(manifest, inputs, params):
+    """one hash over the content of every input file and the parameters of a step"""
+
+    sha1 = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    for name in inputs:
+        sha1.update(name.encode())
+        sha1.update(file_digest(manifest, name).encode())
+
+    return sha1.hexdigest()
+
+
+def is_fresh(manifest, name, inputs, params):
+    """check if step name was built from the same inputs and parameters
+       and its outputs have not been touched since"""
+
+    entry = manifest['steps'].get(name)
+    if entry is None or not all(os.path.exists(input_name) for input_name in inputs):
+        return False
+    if entry['key'] != step_key(manifest, inputs, params):
+        return False
+
+    return all(os.path.exists(out_name) and file_signature(out_name) == signature
+               for out_name, signature in entry['outputs'].items())
+
+
+def record_step(manifest, name, inputs, params, outputs):
+    """remember the inputs, parameters and outputs of step name and save the manifest straight away,
+       so the work done so far is kept if a later step fails"""
+
+    manifest['steps'][name] = {'key': step_key(manifest, inputs, params),
+                               'outputs': {out_name: file_signature(out_name) for out_name in outputs}}
+    save_manifest(manifest)
+
+
+def run_step(manifest, name, inputs, params, action):
+    """run action unless step name is fresh, measured as stage name. action returns the list of files it wrote.
+       Return the outputs of the step"""
+
+    with measure(name) as record:
+        if is_fresh(manifest, name, inputs, params):
+            print("{} is up to date".format(name))
+            record['skipped'] = True
+            return sorted(manifest['steps'][name]['outputs'])
+
+        outputs = action()
+        record_step(manifest, name, inputs, params, outputs)
+        record['outputs'] = outputs
+
+    return outputs
+
+
+def stale_frames(manifest, name_format, frame_inputs, params, total):
+    """return the timesteps i in range(total) whose step name_format.format(i)
+       with inputs frame_inputs(i) is not fresh"""
+
+    return [i for i in range(total) if not is_fresh(manifest, name_format.format(i), frame_inputs(i), params)]
+
+
+def run_frames(manifest, name, frame_inputs, frame_outputs, params, total, points, action):
+    """run action(frames, done) on the timesteps i in range(total) whose step name + ' {:04d}' is not fresh,
+       measured as stage name and every timestep, of points points, as a stage of its own.
+       action calls done(i) once it wrote frame_outputs(i), which records timestep i in the manifest.
+       Return the timesteps taken"""
+
+    name_format = name + ' {:04d}'
+    stale = stale_frames(manifest, name_format, frame_inputs, params, total)
+    print("{} of {} timesteps to redo for {}".format(len(stale), total, name))
+    with measure(name) as record:
+        record['skipped'] = not stale
+        timestep = timestep_recorder(name_format, points)
+
+        def done(i):
+            record_step(manifest, name_format.format(i), frame_inputs(i), params, frame_outputs(i))
+            timestep(i, frame_outputs(i))
+
+        if stale:
+            action(stale, done)
+        record['outputs'] = [out_name for i in stale for out_name in frame_outputs(i)]
+
+    return stale
 
 
 # ===================================================================================================================
 
 def main():
+    global SCALAR_DIVISION_FACTOR  # see --auto-scalar-division
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes used to convert the binary files in step 1 and the tif files in step 2')
+    parser.add_argument('--boundary', choices=('corners', 'hull'), default='corners', help='draw the boundary in step 3 through the 4 extreme points or along the convex hull')
+    parser.add_argument('--stream', action='store_true', help='convert, warp and push every timestep in memory (steps 1, 5 and 6) and only write the pushed surfaces')
+    parser.add_argument('--keep-intermediates', action='store_true', help='with --stream, also write the converted and warped surfaces')
+    parser.add_argument('--series', action='store_true', help='write the pushed amplitude timesteps into one VTKHDF file (needs h5py) instead of one vtp each')
+    parser.add_argument('--resample', choices=RESAMPLE_METHODS, default='nearest', help='how tif pixels are reduced to terrain points in step 2')
+    parser.add_argument('--lod', nargs='*', type=int, metavar='FACTOR', help='also write the terrain reduced by every FACTOR, read in the same pass over the tifs, and index the elevated levels in ' + ELEVATED_TERRAIN_LOD_INDEX + '. Without FACTOR uses ' + ' '.join(map(str, LOD_FACTORS)))
+    parser.add_argument('--terrain-tolerance', type=float, help='thin the terrain of step 2 adaptively, keeping it within this many metres of the full terrain')
+    parser.add_argument('--vtp-encoding', choices=VTP_ENCODINGS, help='how vtp files store their data, default is the vtk default (appended)')
+    parser.add_argument('--vtp-compressor', choices=VTP_COMPRESSORS, help='compression of vtp files, default is the vtk default (zlib)')
+    parser.add_argument('--vtp-level', type=int, choices=range(1, 10), help='compression level of vtp files')
+    parser.add_argument('--vtp-precision', choices=VTP_PRECISIONS, help='store vtp points as float32 or float64, default keeps their type')
+    parser.add_argument('--memory-budget', type=float, metavar='MB', help='take every amplitude timestep through steps 1, 5 and 6 in chunks of points sized to stay around this many megabytes, writing raw uncompressed vtp files. Not used for --series')
+    parser.add_argument('--auto-scalar-division', action='store_true', help='with the amplitude shown as elevation, divide it so that its {} quantile over all timesteps (from {}) is lifted by {} instead of dividing it by {}'.format(AUTO_SCALAR_QUANTILE, SCALAR_STATS_NAME, SCALAR_LIFT, SCALAR_DIVISION_FACTOR))
+    parser.add_argument('--interpolate', type=int, default=0, metavar='K', help='put K frames interpolated in time between every two pushed amplitude timesteps and play them all from ' + AMP_TIMELINE_NAME)
+    parser.add_argument('--cubic', action='store_true', help='with --interpolate, interpolate cubically through the four timesteps around a gap instead of linearly')
+    parser.add_argument('--roi', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='only take the amplitude inside this box and the terrain around it')
+    parser.add_argument('--roi-polygon', type=float, nargs='+', metavar='X Y', help='only take the amplitude inside the polygon with these x y corners and the terrain around it')
+    parser.add_argument('--rebuild', action='store_true', help='ignore ' + MANIFEST_NAME + ' and the terrain cache in ' + TERRAIN_CACHE_DIR + ' and recompute every step')
+    parser.add_argument('--report', default=REPORT_NAME, help='where to write the time, memory and throughput of every step, json or csv by extension')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING'), default='WARNING', help='DEBUG also shows the values found on the way, INFO the measurements of every step')
+    args = parser.parse_args()
+    if args.series and args.interpolate:
+        parser.error("--interpolate needs one vtp per timestep, not --series")
+    if args.roi and args.roi_polygon:
+        parser.error("give either --roi or --roi-polygon")
+    if args.roi_polygon and (len(args.roi_polygon) < 6 or len(args.roi_polygon) % 2):
+        parser.error("--roi-polygon needs at least three x y corners")
+    region = None  # region of interest, a list of x, y corners
+    if args.roi:
+        region = box_polygon(*args.roi)
+    elif args.roi_polygon:
+        region = [[x, y] for x, y in zip(args.roi_polygon[::2], args.roi_polygon[1::2])]
+
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+    run = {'stage': 'all', 'skipped': False, 'points': 0}
+    OPEN_STAGES.append(run)
+    run_start = usage()
+
+    lod_factors = () if args.lod is None else tuple(args.lod or LOD_FACTORS)
+    WRITER_OPTIONS.update(encoding=args.vtp_encoding, compressor=args.vtp_compressor,
+                          level=args.vtp_level, precision=args.vtp_precision)
+
     # change these hard codes when applying different data.
     # Make sure all data files and this py are in the same directory.
 
@@ -585,28 +2332,133 @@ def main():
 
     # extract points from just one file for forming boundary
     print("hahahaha extracting points")
-    point_list = extract_xyz((BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, 0), endianess)
-
-    print("hahahahahahah step 1")
-    convert_binary_to_vtp(binaryNamePrefix, endianess, extension, total)
+    x, y, z = extract_xyz((BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, 0), endianess, region)
+    assert len(x), "no amplitude point lies in the region of interest"
+    point_list = np.column_stack((x, y))
+
+    # steps are skipped when their inputs, parameters and outputs match MANIFEST_NAME
+    manifest = {'digests': {}, 'steps': {}} if args.rebuild else load_manifest()
+    writer = dict(WRITER_OPTIONS)
+    binaries = [(BINARY_PREFIX_FORMAT + extension).format(binaryNamePrefix, i) for i in range(total)]
+    chunk_points = None if args.memory_budget is None else budget_chunk_points(args.memory_budget * (1 << 20))
+
+    if not args.stream:
+        print("hahahahahahah step 1")
+        run_frames(manifest, 'step 1', lambda i: binaries[i:i + 1],
+                   lambda i: [CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)],
+                   {'endianess': endianess, 'region': region, 'writer': writer, 'chunk_points': chunk_points},
+                   total, len(x),
+                   lambda frames, done: convert_binary_to_vtp(binaryNamePrefix, endianess, extension, total,
+                                                              args.jobs, chunk_points, args.rebuild, region,
+                                                              frames, done))
+
+    if args.auto_scalar_division:
+        SCALAR_DIVISION_FACTOR = auto_scalar_division(update_scalar_stats(binaries, endianess, region=region))
+        print("scalar division factor is " + str(SCALAR_DIVISION_FACTOR))
 
     print("hahahahahahah step 2")
-    append_vtps(tifiles)
+    run_step(manifest, 'step 2', sorted(glob.glob(tifiles)),
+             {'counter_factor': COUNTER_FACTOR, 'zz_division_factor': ZZ_DIVISION_FACTOR, 'in_sea': IN_SEA,
+              'resample': args.resample, 'tolerance': args.terrain_tolerance,
+              'adaptive_max_block': ADAPTIVE_MAX_BLOCK, 'lod': lod_factors, 'mesh_version': TERRAIN_MESH_VERSION,
+              'writer': writer, 'region': region},
+             lambda: append_vtps(tifiles, args.resample, jobs=args.jobs,
+                                 cache_dir=None if args.rebuild else TERRAIN_CACHE_DIR,
+                                 tolerance=args.terrain_tolerance, lod_factors=lod_factors, region=region))
 
     print("hahahahahahah step 3")
-    form_boundary(point_list, number_of_points, BOUNDARY_FILENAME)
+    run_step(manifest, 'step 3', binaries[:1],
+             {'boundary': args.boundary, 'number_of_points': number_of_points, 'endianess': endianess,
+              'writer': writer, 'region': region},
+             lambda: write_boundary(point_list, number_of_points, args.boundary))
 
     print("hahahahahahah step 4")
-    form_planes(fault_data_file, number_of_points)
-    faults_sum = file_counter(file_path, 'rapture_data*.vtp')
+    fault_files = run_step(manifest, 'step 4', [fault_data_file],
+                           {'number_of_points': number_of_points, 'fill_faults_factor': FILL_FAULTS_FACTOR,
+                            'writer': writer}, lambda: form_planes(fault_data_file, number_of_points))
+    faults_sum = len(fault_files)
     print("number of faults is " + str(faults_sum))
 
     print("hahahahahahah step 5")
-    create_elevation_surfaces(binaryNamePrefix, total, faults_sum)
+    elevation = []  # the terrain delaunay, only built when a step needs it
+
+    def elevation_delaunay():
+        if not elevation:
+            elevation.append(terrain_surface(read_poly_data(FLAT_TERRAIN_NAME)))
+        return elevation[0]
+
+    run_step(manifest, 'step 5', [FLAT_TERRAIN_NAME, BOUNDARY_FILENAME] + fault_files, {'writer': writer},
+             lambda: create_terrain_surfaces(faults_sum, elevation_delaunay()))
+    if lod_factors:
+        # the level of COUNTER_FACTOR is the elevated terrain of step 5
+        lod_inputs = [ElEVATED_TERRAIN_NAME if factor == COUNTER_FACTOR else terrain_level_names(factor)[0]
+                      for factor in lod_factors]
+        run_step(manifest, 'step 5 lod', lod_inputs,
+                 {'lod': lod_factors, 'writer': writer}, lambda: create_terrain_levels(lod_factors))
+
+    amp_push_value = faults_push_value + AMP_PUSH_OFFSET
+    amp_push_params = {'push_value': amp_push_value, 'scalar_shown': scalar_shown,
+                       'scalar_division_factor': SCALAR_DIVISION_FACTOR, 'writer': writer,
+                       'chunk_points': chunk_points}
+    pushed_amp_files = [('pushed_' + AMP_WARP_FORMAT).format(i) for i in range(total)]
+
+    if args.stream:
+        print("streaming steps 1, 5 and 6 for the amplitude")
+        stream_params = dict(amp_push_params, endianess=endianess, keep_intermediates=args.keep_intermediates,
+                             mesh_version=AMP_MESH_VERSION, region=region)
+
+        def stream(frames=None, done=None, series=False):
+            return stream_amplitude_surfaces(binaryNamePrefix, endianess, extension, total, elevation_delaunay(),
+                                             faults_push_value, scalar_shown, args.keep_intermediates, series,
+                                             frames, done, None if series else chunk_points, region)
+
+        def stream_outputs(i):
+            if args.keep_intermediates:
+                return [CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i), AMP_WARP_FORMAT.format(i),
+                        pushed_amp_files[i]]
+            return [pushed_amp_files[i]]
+
+        if args.series:
+            run_step(manifest, 'stream amplitude series', binaries + [FLAT_TERRAIN_NAME],
+                     dict(stream_params, chunk_points=None), lambda: stream(series=True))
+        else:
+            run_frames(manifest, 'stream amplitude', lambda i: [binaries[i], FLAT_TERRAIN_NAME], stream_outputs,
+                       stream_params, total, len(x), stream)
+    else:
+        run_frames(manifest, 'step 5 amplitude',
+                   lambda i: [FLAT_TERRAIN_NAME, CONVERTED_FILE_FORMAT.format(binaryNamePrefix, i)],
+                   lambda i: [AMP_WARP_FORMAT.format(i)],
+                   {'writer': writer, 'chunk_points': chunk_points, 'mesh_version': AMP_MESH_VERSION}, total, len(x),
+                   lambda frames, done: warp_amplitude_frames(elevation_delaunay(), binaryNamePrefix, frames, done,
+                                                              chunk_points))
 
     print("hahahahahahah step 6")
-    push_surfaces(faults_push_value, total, faults_sum, scalar_shown)
-
+    run_step(manifest, 'step 6 boundary', [BOUNDARY_W_TERRAIN],
+             {'push_value': faults_push_value + BOUNDARY_PUSH_OFFSET, 'writer': writer},
+             lambda: push_warp_surface_up(faults_push_value + BOUNDARY_PUSH_OFFSET, 1, BOUNDARY_W_TERRAIN))
+    run_step(manifest, 'step 6 faults', [FAULT_WARP_FORMAT.format(j) for j in range(faults_sum)],
+             {'push_value': faults_push_value, 'writer': writer},
+             lambda: push_warp_surface_up(faults_push_value, faults_sum, FAULT_WARP_FORMAT))
+
+    if not args.stream:
+        amp_warp_files = [AMP_WARP_FORMAT.format(i) for i in range(total)]
+        if args.series:
+            run_step(manifest, 'step 6 amplitude series', amp_warp_files, dict(amp_push_params, chunk_points=None),
+                     lambda: push_amplitude_series(amp_push_value, total, scalar_shown))
+        else:
+            run_frames(manifest, 'step 6 amplitude', lambda i: amp_warp_files[i:i + 1],
+                       lambda i: pushed_amp_files[i:i + 1], amp_push_params, total, len(x),
+                       lambda frames, done: push_warp_surface_up(amp_push_value, total, AMP_WARP_FORMAT, scalar_shown,
+                                                                 frames, chunk_points, done))
+
+    if args.interpolate:
+        run_step(manifest, 'step 6 interpolate', pushed_amp_files,
+                 {'steps': args.interpolate, 'cubic': args.cubic, 'writer': writer},
+                 lambda: write_timeline(total, args.interpolate, args.cubic))
+
+    OPEN_STAGES.remove(run)
+    finish_stage(run, run_start)
+    write_report(args.report)
     print("all done")
 
     # for renaming. Eg:
@@ -0,0 +1,401 @@
+"""Benchmark the earthquake pipeline on synthetic data, no Kaikoura binaries or LINZ tiles needed.
+   For every scale, amplitude binaries, fault planes and GeoTIFF tiles (built with GDAL's MEM driver)
+   are generated, then steps 1 to 6 are timed, calling the same functions as earthquake_visulization.main.
+   Every vtp written is summed up in a fingerprint (see poly_fingerprint) and compared with a golden file,
+   so a speedup can be shown to leave the output unchanged.
+   The golden file pipeline_benchmark_golden.json holds the fingerprints of the baseline implementation,
+   earthquake_visulization.py as of commit 39ed6dc, recorded with --baseline.
+   Sample commands:
+   git show 39ed6dc:earthquake_visulization.py > baseline_ev.py
+   python pipeline_benchmark.py --scales small medium large --baseline baseline_ev --update-golden  # record the goldens
+   python pipeline_benchmark.py --scales small medium                   # time and check against them
+   python pipeline_benchmark.py --scales small --resample average --lod # record with --update-golden first
+"""
+
+import os
+import sys
+import argparse
+import contextlib
+import glob
+import importlib
+import json
+import shutil
+import tempfile
+import time
+import numpy as np
+from osgeo import gdal
+from vtk.util import numpy_support
+import earthquake_visulization as ev
+
+# amplitude grid (columns, rows), timesteps, terrain tiles per side, tile size in pixels, fault planes
+SCALES = {
+    'small': {'amp_grid': (100, 80), 'frames': 3, 'tiles_per_side': 1, 'tile_pixels': 400, 'planes': 4},
+    'medium': {'amp_grid': (400, 300), 'frames': 5, 'tiles_per_side': 2, 'tile_pixels': 1000, 'planes': 12},
+    'large': {'amp_grid': (1000, 800), 'frames': 10, 'tiles_per_side': 3, 'tile_pixels': 2000, 'planes': 24},
+}
+REGION = (172., 174., -43., -41.5)  # lon min, lon max, lat min, lat max covered by the terrain
+BINARY_PREFIX = 'synthetic_ts'
+EXTENSION = '.0'
+FAULT_DATA_NAME = 'synthetic_faults.txt'
+TILE_FORMAT = 'synthetic_tile_{:02d}.tif'
+TILE_PATTERN = 'synthetic_tile_*.tif'
+GOLDEN_NAME = 'pipeline_benchmark_golden.json'
+NUMBER_OF_POINTS = 40
+FAULTS_PUSH_VALUE = 0.01
+SEED = 0
+RELATIVE_TOLERANCE = 1e-6  # of fingerprint numbers, about float32 precision on longitudes
+CELL_TYPES = ('verts', 'lines', 'polys')
+CELL_TOLERANCE = 0.002  # of cell counts, a delaunay of a grid adds sliver triangles along its hull that a lattice leaves out
+
+
+def make_amplitude_binaries(rng, amp_grid, frames, endianess):
+    """write frames binary files of a rotated amp_grid of points with random amplitudes,
+       the same points in every timestep like the simulation output"""
+
+    lon_min, lon_max, lat_min, lat_max = REGION
+    cx, cy = (lon_min + lon_max) / 2, (lat_min + lat_max) / 2
+    ax, ay = np.meshgrid(np.linspace(cx - 0.35 * (lon_max - lon_min), cx + 0.35 * (lon_max - lon_min), amp_grid[0]),
+                         np.linspace(cy - 0.35 * (lat_max - lat_min), cy + 0.35 * (lat_max - lat_min), amp_grid[1]))
+    theta = 0.3
+    x = cx + (ax - cx) * np.cos(theta) - (ay - cy) * np.sin(theta)
+    y = cy + (ax - cx) * np.sin(theta) + (ay - cy) * np.cos(theta)
+
+    records = np.empty(x.size, dtype=ev.xyz_dtype(endianess))
+    records['x'] = x.ravel()
+    records['y'] = y.ravel()
+    for i in range(frames):
+        records['z'] = rng.random(x.size) * (i + 1)
+        records.tofile((ev.BINARY_PREFIX_FORMAT + EXTENSION).format(BINARY_PREFIX, i))
+
+
+def make_tile(tile_name, elevation, x_origin, y_origin, pixel_width, pixel_height):
+    """build an int16 elevation tile with the MEM driver and copy it to a GeoTIFF file"""
+
+    rows, cols = elevation.shape
+    mem = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Int16)
+    mem.SetGeoTransform((x_origin, pixel_width, 0, y_origin, 0, -pixel_height))
+    mem.GetRasterBand(1).WriteArray(elevation)
+    gdal.GetDriverByName('GTiff').CreateCopy(tile_name, mem)
+
+
+def make_tiles(rng, tiles_per_side, tile_pixels):
+    """cover REGION with tiles_per_side x tiles_per_side terrain tiles, sea (IN_SEA) where the hills dip below 0.
+       Return the tile names"""
+
+    lon_min, lon_max, lat_min, lat_max = REGION
+    pixel_width = (lon_max - lon_min) / (tiles_per_side * tile_pixels)
+    pixel_height = (lat_max - lat_min) / (tiles_per_side * tile_pixels)
+    phase = rng.random(2) * 2 * np.pi
+
+    tile_names = []
+    for row in range(tiles_per_side):
+        for col in range(tiles_per_side):
+            x_origin = lon_min + col * tile_pixels * pixel_width
+            y_origin = lat_max - row * tile_pixels * pixel_height
+            lon = x_origin + np.arange(tile_pixels) * pixel_width
+            lat = y_origin - np.arange(tile_pixels) * pixel_height
+            hills = np.sin(lon * 7 + phase[0])[None, :] + np.cos(lat * 9 + phase[1])[:, None]
+            elevation = np.where(hills < -0.5, ev.IN_SEA, 1200 * (hills + 0.5)).astype(np.int16)
+
+            tile_name = TILE_FORMAT.format(len(tile_names))
+            make_tile(tile_name, elevation, x_origin, y_origin, pixel_width, pixel_height)
+            tile_names.append(tile_name)
+
+    return tile_names
+
+
+def make_fault_planes(rng, planes):
+    """write a fault-data txt of planes random quadrilaterals inside REGION"""
+
+    lon_min, lon_max, lat_min, lat_max = REGION
+    lines = ['synthetic hypocentre', '0 0']
+    for k in range(planes):
+        cx = rng.uniform(lon_min + 0.3, lon_max - 0.3)
+        cy = rng.uniform(lat_min + 0.3, lat_max - 0.3)
+        length, width, angle = rng.uniform(0.1, 0.25), rng.uniform(0.02, 0.08), rng.uniform(0, np.pi)
+        along = np.array([np.cos(angle), np.sin(angle)]) * length
+        across = np.array([-np.sin(angle), np.cos(angle)]) * width
+        lines.append('> plane {}'.format(k))
+        for corner in (-along - across, along - across, along + across, -along + across):
+            lines.append('{:.6f} {:.6f}'.format(cx + corner[0], cy + corner[1]))
+
+    with open(FAULT_DATA_NAME, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+@contextlib.contextmanager
+def silenced():
+    """drop the progress prints of the pipeline"""
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def timed(repeat, function, *args):
+    """call function(*args) repeat times with its prints silenced, measured like a pipeline step.
+       Return the best time, the result and the number of points written by the last call"""
+
+    times = []
+    for _ in range(repeat):
+        with silenced(), ev.measure(function.__name__) as record:
+            start = time.perf_counter()
+            result = function(*args)
+            times.append(time.perf_counter() - start)
+
+    return min(times), result, record['points']
+
+
+def read_frames(module, endianess, frames):
+    """read every binary with the extract_xyz of module and touch all its values, as main does for the boundary"""
+
+    return sum(np.size(module.extract_xyz((ev.BINARY_PREFIX_FORMAT + EXTENSION).format(BINARY_PREFIX, i),
+                                          endianess)) // 3 for i in range(frames))
+
+
+def boundary(endianess):
+    """step 3 on the points of the first timestep"""
+
+    x, y, z = ev.extract_xyz((ev.BINARY_PREFIX_FORMAT + EXTENSION).format(BINARY_PREFIX, 0), endianess)
+
+    return ev.write_boundary(np.column_stack((x, y)), NUMBER_OF_POINTS)
+
+
+def elevation_surfaces(frames, faults_sum, chunk_points=None, lod_factors=()):
+    """step 5 from scratch, without the probe weights of an earlier call:
+       the terrain, boundary and fault surfaces, every amplitude timestep warped by the terrain
+       and the elevated levels of detail"""
+
+    for cache_name in (ev.PROBE_WEIGHTS_NAME, ev.PROBE_WEIGHTS_CHUNKED_NAME):
+        if os.path.exists(cache_name):
+            os.remove(cache_name)
+    elevationDelaunay = ev.terrain_surface(ev.read_poly_data(ev.FLAT_TERRAIN_NAME))
+    ev.create_terrain_surfaces(faults_sum, elevationDelaunay)
+    ev.warp_amplitude_frames(elevationDelaunay, BINARY_PREFIX, range(frames), chunk_points=chunk_points)
+    if lod_factors:
+        ev.create_terrain_levels(lod_factors)
+
+
+def push_surfaces(frames, faults_sum, chunk_points=None):
+    """step 6: push the boundary, the faults and every amplitude timestep up"""
+
+    ev.push_warp_surface_up(FAULTS_PUSH_VALUE + ev.BOUNDARY_PUSH_OFFSET, 1, ev.BOUNDARY_W_TERRAIN)
+    ev.push_warp_surface_up(FAULTS_PUSH_VALUE, faults_sum, ev.FAULT_WARP_FORMAT)
+    ev.push_warp_surface_up(FAULTS_PUSH_VALUE + ev.AMP_PUSH_OFFSET, frames, ev.AMP_WARP_FORMAT, True,
+                            chunk_points=chunk_points)
+
+
+def run_steps(frames, endianess, repeat, chunk_points=None, resample='nearest', lod_factors=()):
+    """time steps 1 to 6 on the data in the current directory, chunk_points amplitude points at a time
+       if it is not None. Return the timings as (stage, seconds, points)"""
+
+    timings = []
+    seconds, points, _ = timed(repeat, read_frames, ev, endianess, frames)
+    timings.append(('extract_xyz', seconds, points))
+
+    seconds, _, points = timed(repeat, ev.convert_binary_to_vtp, BINARY_PREFIX, endianess, EXTENSION, frames, 1,
+                               chunk_points, True)
+    timings.append(('step 1 convert', seconds, points))
+
+    seconds, _, points = timed(repeat, ev.append_vtps, TILE_PATTERN, resample, None, 1, None, None, lod_factors)
+    timings.append(('step 2 terrain', seconds, points))
+
+    seconds, _, points = timed(repeat, boundary, endianess)
+    timings.append(('step 3 boundary', seconds, points))
+
+    seconds, fault_files, points = timed(repeat, ev.form_planes, FAULT_DATA_NAME, NUMBER_OF_POINTS)
+    timings.append(('step 4 faults', seconds, points))
+    faults_sum = len(fault_files)
+
+    seconds, _, points = timed(repeat, elevation_surfaces, frames, faults_sum, chunk_points, lod_factors)
+    timings.append(('step 5 surfaces', seconds, points))
+
+    seconds, _, points = timed(repeat, push_surfaces, frames, faults_sum, chunk_points)
+    timings.append(('step 6 push', seconds, points))
+
+    return timings
+
+
+def run_baseline_steps(baseline, frames, endianess, repeat):
+    """time steps 1 to 6 with the functions of baseline, the module of the baseline implementation,
+       on the data in the current directory. It counts no points. Return the timings as (stage, seconds, points)"""
+
+    timings = []
+    seconds, points, _ = timed(repeat, read_frames, baseline, endianess, frames)
+    timings.append(('extract_xyz', seconds, points))
+
+    seconds, _, _ = timed(repeat, baseline.convert_binary_to_vtp, BINARY_PREFIX, endianess, EXTENSION, frames)
+    timings.append(('step 1 convert', seconds, 0))
+
+    seconds, _, _ = timed(repeat, baseline.append_vtps, TILE_PATTERN)
+    timings.append(('step 2 terrain', seconds, 0))
+
+    first = baseline.extract_xyz((ev.BINARY_PREFIX_FORMAT + EXTENSION).format(BINARY_PREFIX, 0), endianess)
+    seconds, _, _ = timed(repeat, baseline.form_boundary, first, NUMBER_OF_POINTS, ev.BOUNDARY_FILENAME)
+    timings.append(('step 3 boundary', seconds, 0))
+
+    seconds, _, _ = timed(repeat, baseline.form_planes, FAULT_DATA_NAME, NUMBER_OF_POINTS)
+    timings.append(('step 4 faults', seconds, 0))
+    faults_sum = len(glob.glob(ev.FAULT_DATA_FORMAT.replace('{:04d}', '*')))
+
+    seconds, _, _ = timed(repeat, baseline.create_elevation_surfaces, BINARY_PREFIX, frames, faults_sum)
+    timings.append(('step 5 surfaces', seconds, 0))
+
+    seconds, _, _ = timed(repeat, baseline.push_surfaces, FAULTS_PUSH_VALUE, frames, faults_sum, True)
+    timings.append(('step 6 push', seconds, 0))
+
+    return timings
+
+
+def column_stats(values):
+    """min, max, mean, standard deviation and quartiles of every column of values"""
+
+    values = values.astype(np.float64).reshape(len(values), -1)
+    if not len(values):
+        return []
+
+    return np.concatenate((values.min(axis=0), values.max(axis=0), values.mean(axis=0), values.std(axis=0),
+                           np.percentile(values, [25, 50, 75], axis=0).ravel())).tolist()
+
+
+def poly_fingerprint(vtpName):
+    """sum up a vtp file in numbers that neither the order of its points and cells nor last-bit noise change:
+       the number of points and of cells of every type, column_stats of the points and of every point data array,
+       and the area the triangles cover in x, y.
+       So a faster triangulation of the same points, which may pick other diagonals, still matches"""
+
+    poly_data = ev.read_poly_data(vtpName)
+    point_data = poly_data.GetPointData()
+    points = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData()) if poly_data.GetPoints() else np.empty((0, 3))
+    fingerprint = {'points': poly_data.GetNumberOfPoints(), 'Points': column_stats(points)}
+    for i in range(point_data.GetNumberOfArrays()):
+        fingerprint[point_data.GetArrayName(i)] = column_stats(numpy_support.vtk_to_numpy(point_data.GetArray(i)))
+    for cell_type, cells in zip(CELL_TYPES, (poly_data.GetVerts(), poly_data.GetLines(), poly_data.GetPolys())):
+        if cells.GetNumberOfCells():
+            fingerprint[cell_type] = cells.GetNumberOfCells()
+
+    polys = poly_data.GetPolys()
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    if polys.GetNumberOfCells() and len(connectivity) == 3 * polys.GetNumberOfCells():
+        a, b, c = [points[connectivity[corner::3], :2].astype(np.float64) for corner in range(3)]
+        fingerprint['xy_area'] = float(np.abs((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) -
+                                              (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])).sum() / 2)
+
+    return fingerprint
+
+
+def run_scale(scale, endianess, repeat, chunk_points=None, resample='nearest', lod_factors=(), baseline=None):
+    """generate the data of one scale in a temporary directory and time the pipeline on it,
+       or the baseline implementation if baseline, its module, is given.
+       Return the timings as (stage, seconds, points) and the poly_fingerprint of every vtp written"""
+
+    settings = SCALES[scale]
+    rng = np.random.default_rng(SEED)
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp_dir)
+        make_amplitude_binaries(rng, settings['amp_grid'], settings['frames'], endianess)
+        make_tiles(rng, settings['tiles_per_side'], settings['tile_pixels'])
+        make_fault_planes(rng, settings['planes'])
+
+        if baseline is None:
+            timings = run_steps(settings['frames'], endianess, repeat, chunk_points, resample, lod_factors)
+        else:
+            timings = run_baseline_steps(baseline, settings['frames'], endianess, repeat)
+        fingerprints = {vtpName: poly_fingerprint(vtpName) for vtpName in sorted(glob.glob('*.vtp'))}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+    return timings, fingerprints
+
+
+def golden_key(scale, resample='nearest', lod_factors=()):
+    """name of the goldens of a scale run with other than the default resampling or levels of detail"""
+
+    key = scale if resample == 'nearest' else '{} resample={}'.format(scale, resample)
+
+    return key if not lod_factors else '{} lod={}'.format(key, ','.join(map(str, lod_factors)))
+
+
+def same_fingerprint(golden, fingerprint, tolerance):
+    """check that fingerprint has every number of golden, equal within tolerance or RELATIVE_TOLERANCE of them.
+       Cell counts only have to be within CELL_TOLERANCE of them.
+       Numbers golden does not have, such as arrays or cells added since, are not checked"""
+
+    for name, expected in golden.items():
+        if name not in fingerprint or np.shape(expected) != np.shape(fingerprint[name]):
+            return False
+        if name in CELL_TYPES:
+            close = np.isclose(fingerprint[name], expected, rtol=CELL_TOLERANCE, atol=0)
+        else:
+            close = np.allclose(fingerprint[name], expected, rtol=RELATIVE_TOLERANCE, atol=tolerance)
+        if not close:
+            return False
+
+    return True
+
+
+def compare_fingerprints(golden, fingerprints, tolerance):
+    """return the names of golden that were not written or whose fingerprint differs"""
+
+    return sorted(name for name in golden
+                  if name not in fingerprints or not same_fingerprint(golden[name], fingerprints[name], tolerance))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=['small'], help='sizes of synthetic data to run')
+    parser.add_argument('--endianess', choices=('little', 'big'), default='big', help='endianess of the synthetic binaries')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times each stage is timed, the best time is reported')
+    parser.add_argument('--memory-budget', type=float, metavar='MB', help='take the amplitude through steps 1, 5 and 6 in chunks of points sized to stay around this many megabytes, as the pipeline does')
+    parser.add_argument('--resample', choices=ev.RESAMPLE_METHODS, default='nearest', help='how tif pixels are reduced to terrain points in step 2')
+    parser.add_argument('--lod', nargs='*', type=int, metavar='FACTOR', help='also write and elevate the terrain reduced by every FACTOR, without FACTOR uses ' + ' '.join(map(str, ev.LOD_FACTORS)))
+    parser.add_argument('--baseline', metavar='MODULE', help='time MODULE, a copy of earthquake_visulization.py at the baseline commit, instead of the current pipeline')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='how far a number of a fingerprint may be from the golden one, on top of a relative ' + str(RELATIVE_TOLERANCE))
+    parser.add_argument('--golden', default=GOLDEN_NAME, help='json file with the fingerprints of a known good run')
+    parser.add_argument('--update-golden', action='store_true', help='write the fingerprints of this run to the golden file instead of checking them')
+    args = parser.parse_args()
+    lod_factors = () if args.lod is None else tuple(args.lod or ev.LOD_FACTORS)
+    if args.baseline and (args.memory_budget is not None or args.resample != 'nearest' or lod_factors):
+        parser.error("the baseline has no --memory-budget, --resample or --lod")
+    baseline = importlib.import_module(args.baseline) if args.baseline else None
+
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden) as f:
+            golden = json.load(f)
+
+    mismatches = 0
+    chunk_points = None if args.memory_budget is None else ev.budget_chunk_points(args.memory_budget * (1 << 20))
+    print("{:<7} {:<26} {:>10} {:>12} {:>14}".format('scale', 'stage', 'time (s)', 'points', 'points/s'))
+    for scale in args.scales:
+        timings, fingerprints = run_scale(scale, args.endianess, args.repeat, chunk_points, args.resample,
+                                          lod_factors, baseline)
+        for stage, seconds, points in timings:
+            print("{:<7} {:<26} {:>10.4f} {:>12} {:>14.0f}".format(scale, stage, seconds, points,
+                                                                 points / seconds if seconds > 0 else 0))
+
+        key = golden_key(scale, args.resample, lod_factors)
+        if args.update_golden:
+            golden[key] = fingerprints
+        elif key not in golden:
+            print("{}: no golden fingerprints in {}, run with --update-golden first".format(key, args.golden))
+        else:
+            differ = compare_fingerprints(golden[key], fingerprints, args.tolerance)
+            mismatches += len(differ)
+            print("{}: {} of {} golden outputs match, {} outputs have no golden".format(
+                key, len(golden[key]) - len(differ), len(golden[key]), len(set(fingerprints) - set(golden[key]))))
+            for name in differ:
+                print("    differs: " + name)
+
+    if args.update_golden:
+        with open(args.golden, 'w') as f:
+            json.dump(golden, f, indent=1, sort_keys=True)
+        print("wrote " + args.golden)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""vtk utils: build vtk poly data straight from numpy arrays, configure vtp writers,
+   write and memory-map vtp files chunk by chunk"""
+
+from xml.etree import ElementTree
+import re
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+VTP_ENCODINGS = ('ascii', 'binary', 'appended', 'raw')  # appended is base64 encoded, raw is not
+VTP_COMPRESSORS = ('none', 'zlib', 'lz4', 'lzma')
+VTP_PRECISIONS = ('float32', 'float64')
+
+
+def build_points(x, y, z):
+    """pack x, y, z columns into one float32 buffer and wrap it as vtkPoints without a further copy"""
+
+    xyz = np.empty((len(x), 3), dtype=np.float32)
+    xyz[:, 0] = x
+    xyz[:, 1] = y
+    xyz[:, 2] = z
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(xyz, deep=False))
+
+    return points
+
+
+def build_vertices(total):
+    """one vertex cell per point, given as a single bulk offsets/connectivity pair"""
+
+    ids = np.arange(total + 1, dtype=numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE])
+    vertices = vtk.vtkCellArray()
+    vertices.SetData(numpy_support.numpy_to_vtkIdTypeArray(ids, deep=False),
+                     numpy_support.numpy_to_vtkIdTypeArray(ids[:-1], deep=False))
+
+    return vertices
+
+
+def build_triangles(triangles):
+    """triangle cells from an n x 3 array of point ids, given as a single bulk offsets/connectivity pair"""
+
+    id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    connectivity = np.ascontiguousarray(triangles, dtype=id_type).ravel()
+    offsets = np.arange(0, len(connectivity) + 1, 3, dtype=id_type)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=False),
+                  numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=False))
+
+    return cells
+
+
+def build_scalars(values, name=None):
+    """wrap a numpy array as a vtkFloatArray"""
+
+    values = np.ascontiguousarray(values, dtype=np.float32)
+    scalars = numpy_support.numpy_to_vtk(values, deep=False)
+    if name is not None:
+        scalars.SetName(name)
+
+    return scalars
+
+
+def build_poly(x, y, z, scalars, scalar_name=None):
+    """build a vertex polyData in one shot from numpy arrays:
+       x, y, z are the point coordinates and scalars the point scalar data"""
+
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(build_points(x, y, z))
+    polyData.SetVerts(build_vertices(len(x)))
+    polyData.GetPointData().SetScalars(build_scalars(scalars, scalar_name))
+
+    return polyData
+
+
+def configure_writer(writer, encoding=None, compressor=None, level=None):
+    """set the encoding (one of VTP_ENCODINGS), compressor (one of VTP_COMPRESSORS)
+       and compression level (1-9) of a vtk xml writer. None keeps the vtk default"""
+
+    if encoding == 'ascii':
+        writer.SetDataModeToAscii()
+    elif encoding == 'binary':
+        writer.SetDataModeToBinary()
+    elif encoding in ('appended', 'raw'):
+        writer.SetDataModeToAppended()
+        writer.SetEncodeAppendedData(encoding == 'appended')
+
+    if compressor == 'none':
+        writer.SetCompressorTypeToNone()
+    elif compressor == 'zlib':
+        writer.SetCompressorTypeToZLib()
+    elif compressor == 'lz4':
+        writer.SetCompressorTypeToLZ4()
+    elif compressor == 'lzma':
+        writer.SetCompressorTypeToLZMA()
+
+    if level is not None:
+        writer.SetCompressionLevel(level)
+
+
+def with_points_precision(polyData, precision=None):
+    """return polyData with its points stored as precision (one of VTP_PRECISIONS).
+       A shallow copy with converted points is made only when the type changes"""
+
+    if precision is None:
+        return polyData
+
+    data = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    if data.dtype == np.dtype(precision):
+        return polyData
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(data.astype(precision), deep=True))
+    converted = vtk.vtkPolyData()
+    converted.ShallowCopy(polyData)
+    converted.SetPoints(points)
+
+    return converted
+
+
+def append_rows(dataset, rows):
+    """append rows to a resizable h5py dataset"""
+
+    rows = np.asarray(rows)
+    start = dataset.shape[0]
+    dataset.resize(start + len(rows), axis=0)
+    dataset[start:] = rows
+
+
+def write_vtkhdf_series(out_name, poly_datas, time_values=None):
+    """write an iterable of poly data as the time steps of a single VTKHDF file (Paraview 5.12 or newer).
+       Points and point data are stored for every step. Polygons are stored once and shared
+       by every following step with the same triangulation, so a series whose geometry
+       only moves in z keeps its topology once. Steps are written as they come, only one is in memory.
+       Needs h5py"""
+
+    import h5py  # only needed for this output
+
+    with h5py.File(out_name, 'w') as f:
+        root = f.create_group('VTKHDF')
+        root.attrs['Version'] = np.array([2, 0], dtype=np.int64)
+        root.attrs.create('Type', np.bytes_('PolyData'))
+
+        def dataset(group, name, shape=(0,), dtype=np.int64):
+            return group.create_dataset(name, shape=shape, maxshape=(None,) + shape[1:], dtype=dtype, chunks=True)
+
+        points = None  # created with the point type of the first step
+        number_of_points = dataset(root, 'NumberOfPoints')
+        topologies = {}
+        for name in ('Vertices', 'Lines', 'Polygons', 'Strips'):
+            group = root.create_group(name)
+            topologies[name] = {key: dataset(group, key) for key in
+                                ('NumberOfCells', 'NumberOfConnectivityIds', 'Offsets', 'Connectivity')}
+        point_data = root.create_group('PointData')
+        root.create_group('CellData')
+        root.create_group('FieldData')
+
+        steps = root.create_group('Steps')
+        values = dataset(steps, 'Values', dtype=np.float64)
+        part_offsets = dataset(steps, 'PartOffsets')
+        number_of_parts = dataset(steps, 'NumberOfParts')
+        point_offsets = dataset(steps, 'PointOffsets')
+        cell_offsets = dataset(steps, 'CellOffsets', (0, 4))
+        connectivity_offsets = dataset(steps, 'ConnectivityIdOffsets', (0, 4))
+        point_data_offsets = steps.create_group('PointDataOffsets')
+        steps.create_group('CellDataOffsets')
+        steps.create_group('FieldDataOffsets')
+
+        last_connectivity = None
+        last_cells = 0
+        last_part = -1
+        n_steps = 0
+        cell_start = [0, 0, 0, 0]  # where the current part starts in vertices, lines, polygons and strips
+        id_start = [0, 0, 0, 0]
+        for step, poly_data in enumerate(poly_datas):
+            xyz = numpy_support.vtk_to_numpy(poly_data.GetPoints().GetData())
+            if points is None:
+                points = dataset(root, 'Points', (0, 3), xyz.dtype)
+            polys = poly_data.GetPolys()
+            offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+            connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+
+            # a new part whenever the point count or the triangulation changes
+            if (last_connectivity is None or len(xyz) != number_of_points[last_part] or
+                    not np.array_equal(connectivity, last_connectivity)):
+                if last_connectivity is not None:
+                    cell_start[2] += last_cells
+                    id_start[2] += len(last_connectivity)
+                append_rows(number_of_points, [len(xyz)])
+                for name, topology in topologies.items():
+                    if name == 'Polygons':
+                        append_rows(topology['NumberOfCells'], [len(offsets) - 1])
+                        append_rows(topology['NumberOfConnectivityIds'], [len(connectivity)])
+                        append_rows(topology['Offsets'], offsets)
+                        append_rows(topology['Connectivity'], connectivity)
+                    else:
+                        append_rows(topology['NumberOfCells'], [0])
+                        append_rows(topology['NumberOfConnectivityIds'], [0])
+                        append_rows(topology['Offsets'], [0])
+                last_connectivity = connectivity.copy()
+                last_cells = len(offsets) - 1
+                last_part += 1
+
+            append_rows(values, [step if time_values is None else time_values[step]])
+            append_rows(part_offsets, [last_part])
+            append_rows(number_of_parts, [1])
+            append_rows(point_offsets, [points.shape[0]])
+            append_rows(cell_offsets, [cell_start])
+            append_rows(connectivity_offsets, [id_start])
+            append_rows(points, xyz)
+
+            data = poly_data.GetPointData()
+            for i in range(data.GetNumberOfArrays()):
+                name = data.GetArrayName(i) or 'Scalars_'
+                array = numpy_support.vtk_to_numpy(data.GetArray(i))
+                if name not in point_data:
+                    dataset(point_data, name, (0,) + array.shape[1:], array.dtype)
+                    dataset(point_data_offsets, name)
+                append_rows(point_data_offsets[name], [point_data[name].shape[0]])
+                append_rows(point_data[name], array)
+            n_steps += 1
+
+        steps.attrs['NSteps'] = n_steps
+
+
+XML_TYPES = {'float32': 'Float32', 'float64': 'Float64', 'int8': 'Int8', 'uint8': 'UInt8',
+             'int32': 'Int32', 'int64': 'Int64'}
+CELL_SECTIONS = ('Verts', 'Lines', 'Strips', 'Polys')
+INLINE_ARRAY = re.compile(rb'<DataArray[^>]*format="(binary|ascii)"')  # data in the xml, nothing to map
+HEADER_BLOCK = 1 << 16   # map_vtp reads the xml header this many bytes at a time
+HEADER_OVERLAP = 1024    # and searches each block with this much of the one before, for tags across blocks
+
+
+def write_vtp_chunks(out_name, number_of_points, chunks, point_arrays=(), verts=False, polys=None):
+    """write a vtp file whose points and point data come in chunks, so only one chunk is ever in memory.
+       point_arrays lists (name, numpy dtype, number of components) of the point data, the first is the scalars.
+       chunks yields (start, xyz, values) with values one array per entry of point_arrays.
+       verts adds one vertex cell per point, polys is an n x 3 array of triangles (a memmap is fine).
+       The data is appended raw and uncompressed, the file is preallocated and every chunk written in place"""
+
+    number_of_polys = 0 if polys is None else len(polys)
+    sections = [('PointData', name, np.dtype(dtype), components, number_of_points * components)
+                for name, dtype, components in point_arrays]
+    sections.append(('Points', 'Points', np.dtype(np.float32), 3, number_of_points * 3))
+    counts = {'Verts': number_of_points if verts else 0, 'Lines': 0, 'Strips': 0, 'Polys': number_of_polys}
+    sizes = {'Verts': 1, 'Lines': 0, 'Strips': 0, 'Polys': 3}
+    for cell_type in CELL_SECTIONS:
+        sections.append((cell_type, 'connectivity', np.dtype(np.int64), 1, counts[cell_type] * sizes[cell_type]))
+        sections.append((cell_type, 'offsets', np.dtype(np.int64), 1, counts[cell_type]))
+
+    offsets = []
+    offset = 0
+    for _, _, dtype, _, length in sections:
+        offsets.append(offset)
+        offset += 8 + length * dtype.itemsize  # every array starts with its UInt64 byte count
+
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian" header_type="UInt64">',
+             '  <PolyData>',
+             '    <Piece NumberOfPoints="{}" NumberOfVerts="{}" NumberOfLines="0" NumberOfStrips="0" '
+             'NumberOfPolys="{}">'.format(number_of_points, counts['Verts'], number_of_polys)]
+    current = None
+    for (section, name, dtype, components, _), offset in zip(sections, offsets):
+        if section != current:
+            if current is not None:
+                lines.append('      </{}>'.format(current))
+            if section == 'Points':
+                lines.append('      <CellData>')
+                lines.append('      </CellData>')
+            if section == 'PointData' and point_arrays:
+                lines.append('      <PointData Scalars="{}">'.format(point_arrays[0][0]))
+            else:
+                lines.append('      <{}>'.format(section))
+            current = section
+        lines.append('        <DataArray type="{}"{} Name="{}" NumberOfComponents="{}" format="appended" '
+                     'offset="{}"/>'.format(XML_TYPES[dtype.name], ' IdType="1"' if name == 'connectivity' else '',
+                                            name, components, offset))
+    lines += ['      </{}>'.format(current), '    </Piece>', '  </PolyData>', '  <AppendedData encoding="raw">', '   _']
+
+    with open(out_name, 'wb') as f:
+        f.write('\n'.join(lines).encode())
+        base = f.tell()
+        f.truncate(base + offset)
+        f.seek(base + offset)
+        f.write(b'\n  </AppendedData>\n</VTKFile>\n')
+
+        for (_, _, dtype, _, length), offset in zip(sections, offsets):
+            f.seek(base + offset)
+            f.write(np.uint64(length * dtype.itemsize).tobytes())
+
+        def put(k, start, values):
+            _, _, dtype, components, _ = sections[k]
+            f.seek(base + offsets[k] + 8 + start * components * dtype.itemsize)
+            f.write(np.ascontiguousarray(values, dtype=dtype.newbyteorder('<')).tobytes())
+
+        written = 0
+        points = len(point_arrays)
+        for start, xyz, values in chunks:
+            for k, array in enumerate(values):
+                put(k, start, array)
+            put(points, start, xyz)
+            if verts:
+                ids = np.arange(start, start + len(xyz), dtype=np.int64)
+                put(points + 1, start, ids)
+                put(points + 2, start, ids + 1)
+            written += len(xyz)
+        assert written == number_of_points, "chunks must cover every point"
+
+        step = 1 << 20
+        for start in range(0, number_of_polys, step):
+            triangles = np.asarray(polys[start:start + step], dtype=np.int64)
+            put(points + 7, start * 3, triangles)
+            put(points + 8, start, 3 * np.arange(start + 1, start + len(triangles) + 1, dtype=np.int64))
+
+
+def map_vtp(vtpName):
+    """memory-map the arrays of a single piece vtp file stored as raw, uncompressed appended data,
+       as write_vtp_chunks writes them. Return a dict with the n x 3 'points', the 'point_data' arrays
+       by name (in file order), the 'scalars' name and the (connectivity, offsets) of every cell type,
+       or None when the file is stored any other way"""
+
+    # the xml header ends at </PolyData>, the appended data follows it
+    head = bytearray()
+    end = appended = -1
+    with open(vtpName, 'rb') as f:
+        while appended < 0 or head.find(b'_', appended) < 0:
+            block = f.read(HEADER_BLOCK)
+            start = max(len(head) - HEADER_OVERLAP, 0)
+            head += block
+            if end < 0:
+                end = head.find(b'</PolyData>', start)
+                if INLINE_ARRAY.search(head, start, len(head) if end < 0 else end):
+                    return None
+            if end >= 0 and appended < 0:
+                appended = head.find(b'<AppendedData', end)
+                if appended < 0 and len(head) - end > HEADER_OVERLAP:
+                    return None
+            if not block:
+                return None
+    head = bytes(head)
+    if not head.startswith(b'<AppendedData encoding="raw">', appended):
+        return None
+    base = head.index(b'_', appended) + 1  # array offsets count from just after the underscore
+
+    root = ElementTree.fromstring(head[:appended] + b'</VTKFile>')
+    if root.get('compressor') or root.get('byte_order') != 'LittleEndian' or len(root.findall('./PolyData/Piece')) != 1:
+        return None
+    header = np.dtype('<u8') if root.get('header_type') == 'UInt64' else np.dtype('<u4')
+    types = {xml_type: np.dtype(name).newbyteorder('<') for name, xml_type in XML_TYPES.items()}
+    piece = root.find('./PolyData/Piece')
+
+    def mapped(array):
+        dtype = types[array.get('type')]
+        components = int(array.get('NumberOfComponents', 1))
+        offset = base + int(array.get('offset'))
+        size = int(np.fromfile(vtpName, dtype=header, count=1, offset=offset)[0])
+        if size == 0:
+            return np.empty((0, components) if components > 1 else 0, dtype=dtype)
+        shape = (size // dtype.itemsize // components, components) if components > 1 else size // dtype.itemsize
+        return np.memmap(vtpName, dtype=dtype, mode='r', offset=offset + header.itemsize, shape=shape)
+
+    point_data = piece.find('PointData')
+    result = {'points': mapped(piece.find('Points/DataArray')),
+              'point_data': {array.get('Name'): mapped(array) for array in point_data.findall('DataArray')},
+              'scalars': point_data.get('Scalars')}
+    for cell_type in CELL_SECTIONS:
+        arrays = {array.get('Name'): array for array in piece.findall(cell_type + '/DataArray')}
+        result[cell_type.lower()] = tuple(mapped(arrays[name]) for name in ('connectivity', 'offsets')) \
+            if arrays else (np.empty(0, np.int64), np.empty(0, np.int64))
+
+    return result
@@ -0,0 +1,93 @@
+"""Benchmark vtp encodings on a sample frame: write time, file size and read time
+   (the read is done with vtkXMLPolyDataReader, the same reader Paraview uses)
+   Sample command:
+   python vtp_benchmark.py pushed_amplitudeWarpSurface_0000.vtp --repeat 5
+"""
+
+import os
+import argparse
+import itertools
+import shutil
+import tempfile
+import time
+import vtk
+from vtk_utils import configure_writer, with_points_precision, VTP_ENCODINGS, VTP_COMPRESSORS, VTP_PRECISIONS
+
+LEVELS = (1, 5, 9)
+
+
+def read_poly_data(vtpName):
+    """read a vtp file"""
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(vtpName)
+    reader.Update()
+    poly_data = reader.GetOutput()
+
+    return poly_data
+
+
+def settings():
+    """yield every (encoding, compressor, level, precision) worth measuring.
+       ascii is never compressed and only compressed settings get a level"""
+
+    for encoding, compressor, precision in itertools.product(VTP_ENCODINGS, VTP_COMPRESSORS, VTP_PRECISIONS):
+        if encoding == 'ascii':
+            if compressor == 'none':
+                yield encoding, compressor, None, precision
+        elif compressor == 'none':
+            yield encoding, compressor, None, precision
+        else:
+            for level in LEVELS:
+                yield encoding, compressor, level, precision
+
+
+def time_setting(poly_data, out_name, encoding, compressor, level, precision, repeat):
+    """write and read poly_data repeat times with one setting,
+       return the best write time, file size and best read time"""
+
+    data = with_points_precision(poly_data, precision)
+    write_times = []
+    read_times = []
+    for _ in range(repeat):
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(out_name)
+        writer.SetInputData(data)
+        configure_writer(writer, encoding, compressor, level)
+        start = time.perf_counter()
+        writer.Write()
+        write_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        read_poly_data(out_name)
+        read_times.append(time.perf_counter() - start)
+
+    return min(write_times), os.path.getsize(out_name), min(read_times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sample', type=str, help='vtp file to benchmark, eg. a pushed_amplitudeWarpSurface_*.vtp frame')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times each setting is timed, the best time is reported')
+    args = parser.parse_args()
+
+    poly_data = read_poly_data(args.sample)
+    print("{} points, {} cells, {} bytes on disk".format(poly_data.GetNumberOfPoints(), poly_data.GetNumberOfCells(),
+                                                        os.path.getsize(args.sample)))
+    print("{:<9} {:<10} {:>5} {:<9} {:>10} {:>12} {:>10}".format('encoding', 'compressor', 'level', 'precision',
+                                                                 'write (s)', 'size (bytes)', 'read (s)'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        out_name = os.path.join(tmp_dir, 'benchmark.vtp')
+        for encoding, compressor, level, precision in settings():
+            write_time, size, read_time = time_setting(poly_data, out_name, encoding, compressor, level, precision,
+                                                       args.repeat)
+            print("{:<9} {:<10} {:>5} {:<9} {:>10.4f} {:>12} {:>10.4f}".format(
+                encoding, compressor, '-' if level is None else level, precision, write_time, size, read_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()